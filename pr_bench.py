@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import sys
+import getopt
+import time
+import random
+import StringIO
+import os
+import tempfile
+
+import pr_svn
+import pr_build
+import pr_utils
+
+help_message = '''
+Project Reality Mod Build Benchmarks
+
+Usage:
+	
+	python pr_bench.py [args]
+
+Options:
+	
+	-p --paths        number of changed paths in the synthetic log (default 100000)
+	-e --entries      number of entries in the synthetic xml log (default 20000)
+	-s --seed         random seed for the synthetic data (default 1)
+	
+	-b --build        folder for synthetic core and levels repos, times a
+	                  full build on them (skipped by default, kept between runs)
+	-f --files        number of files in the synthetic repos (default 200000)
+	-g --gigabytes    size of the synthetic repos (default 40)
+	-r --results      results history, compared with the last run (default bench_results.txt)
+'''
+
+options = {
+	'paths': 100000,
+	'entries': 20000,
+	'seed': 1,
+	'build': None,
+	'files': 200000,
+	'gigabytes': 40,
+	'results': 'bench_results.txt'
+}
+
+# ( name, seconds, count ) of every benchmark in this run
+results = []
+
+# slower than the last recorded run by more than this is a regression,
+# differences under the noise floor in seconds are ignored
+regression = 1.2
+noise = 0.1
+
+class Usage(Exception):
+	def __init__(self, msg):
+		self.msg = msg
+
+def main(argv=None):
+	global options
+	
+	if argv is None:
+		argv = sys.argv
+	try:
+		try:
+			opts, args = getopt.getopt(argv[1:], "hp:e:s:b:f:g:r:", [ "help", "paths=", "entries=", "seed=", "build=", "files=", "gigabytes=", "results=" ])
+		except getopt.error, msg:
+			raise Usage(msg)
+		
+		for option, value in opts:
+			
+			if option in ("-h", "--help"):
+				raise Usage(help_message)
+			
+			if option in ("-b", "--build"):
+				options['build'] = value
+			if option in ("-r", "--results"):
+				options['results'] = value
+			
+			try:
+				if option in ("-p", "--paths"):
+					options['paths'] = int( value )
+				if option in ("-e", "--entries"):
+					options['entries'] = int( value )
+				if option in ("-s", "--seed"):
+					options['seed'] = int( value )
+				if option in ("-f", "--files"):
+					options['files'] = int( value )
+				if option in ("-g", "--gigabytes"):
+					options['gigabytes'] = float( value )
+			except ValueError:
+				raise Usage('%s must be a number' % option)
+		
+		random.seed( options['seed'] )
+		
+		bench_get_paths( options['paths'] )
+		bench_get_log( options['entries'] )
+		bench_log_cache( options['entries'] )
+		
+		if options['build']:
+			bench_build( options['build'], options['files'], int( options['gigabytes'] * 2 ** 30 ) )
+		
+		save_results( options['results'] )
+	
+	except Usage, err:
+		print >> sys.stderr, sys.argv[0].split("/")[-1] + ": " + str(err.msg)
+		return 2
+
+def bench_get_paths( total ):
+	
+	print 'get_paths'
+	
+	sizes = []
+	count = 1000
+	while count < total:
+		sizes.append( count )
+		count *= 10
+	sizes.append( total )
+	
+	last = None
+	for count in sizes:
+		
+		logs = synthetic_log( count )
+		
+		start = time.time()
+		pr_svn.get_paths( logs, [ 'trunk', 'levels' ] )
+		elapsed = time.time() - start
+		
+		line = '%10s paths %8.3fs %8.2fus/path' % ( count, elapsed, elapsed * 10 ** 6 / count )
+		if last:
+			line += '   x%.1f time for x%.1f paths' % ( elapsed / max( last[1], 0.000001 ), float( count ) / last[0] )
+		print line
+		
+		record( 'get_paths %s' % count, elapsed, count )
+		
+		last = ( count, elapsed )
+
+def bench_get_log( total ):
+	
+	print 'get_log'
+	
+	data = synthetic_xml( total )
+	
+	start = time.time()
+	count = 0
+	for entry in pr_svn.get_log( StringIO.StringIO( data ), True, True ):
+		count += 1
+	elapsed = time.time() - start
+	
+	print '%10s entries %8.3fs %8.2fus/entry' % ( count, elapsed, elapsed * 10 ** 6 / max( count, 1 ) )
+	
+	record( 'get_log %s' % total, elapsed, count )
+
+def bench_log_cache( total ):
+	
+	print 'log cache'
+	
+	if not pr_svn.sqlite3:
+		print 'sqlite3 not available'
+		return
+	
+	temp, pr_svn.log_cache = tempfile.mkstemp( '.db' )
+	os.close( temp )
+	
+	try:
+		
+		# fill the store as if svn had already been asked for every revision
+		db = pr_svn.open_cache()
+		entries = []
+		for r, a, d, m, p in pr_svn.read_log( StringIO.StringIO( synthetic_xml( total ) ) ):
+			db.execute( 'INSERT INTO entries VALUES ( ?, ?, ?, ?, ?, ? )', ( 'bench://log', r, a, d, m, '\n'.join( [ '%s %s' % x for x in p ] ) ) )
+			entries.append( ( r, [ x[1] for x in p ] ) )
+		pr_svn.index( db, 'bench://log', entries )
+		db.execute( 'INSERT INTO ranges VALUES ( ?, ?, ? )', ( 'bench://log', 1, total ) )
+		db.commit()
+		db.close()
+		
+		for count in [ c for c in [ 100, 1000 ] if c < total ] + [ total ]:
+			
+			start = time.time()
+			entries = pr_svn.cached_log( 'bench://log', '%s:%s' % ( total - count + 1, total ) )
+			elapsed = time.time() - start
+			
+			print '%10s entries %8.3fs %8.2fus/entry' % ( len( entries ), elapsed, elapsed * 10 ** 6 / max( len( entries ), 1 ) )
+			
+			record( 'log cache %s' % count, elapsed, len( entries ) )
+		
+		print 'path index'
+		
+		for subtree in [ 'levels/level7', 'objects/vehicles_server-zip' ]:
+			
+			start = time.time()
+			entries = pr_svn.cached_log( 'bench://log', '1:%s' % total, subtree )
+			elapsed = time.time() - start
+			
+			start = time.time()
+			scanned = list( pr_svn.within( pr_svn.cached_log( 'bench://log', '1:%s' % total ), subtree ) )
+			scan = time.time() - start
+			
+			print '%10s entries %8.3fs (scanning %.3fs) %s' % ( len( entries ), elapsed, scan, subtree )
+			
+			record( 'path index %s' % subtree, elapsed, len( entries ) )
+	
+	finally:
+		os.remove( pr_svn.log_cache )
+		pr_svn.log_cache = None
+
+def bench_build( path, files, size ):
+	
+	print 'build'
+	
+	repos = os.path.join( path, 'repos' )
+	synthetic_repos( repos, files, size )
+	
+	builds = os.path.join( path, 'builds' )
+	pr_utils.delete( path=builds )
+	os.makedirs( builds )
+	
+	# the synthetic repos are plain folders, exports are copies
+	pr_build.update_repo = lambda path, revision: None
+	pr_build.export_repo = lambda path, destination: pr_utils.copy( path, destination )
+	
+	pr_build.core_path    = os.path.join( repos, 'core' )
+	pr_build.levels_path  = os.path.join( repos, 'levels' )
+	pr_build.builds_path  = builds
+	pr_build.logs_path    = os.path.join( builds, 'logs' )
+	pr_build.core_build   = os.path.join( builds, 'core' )
+	pr_build.levels_build = os.path.join( builds, 'levels' )
+	pr_build.full_build   = os.path.join( builds, 'full' )
+	pr_build.server_build = os.path.join( builds, 'server' )
+	pr_build.cache_build  = os.path.join( builds, 'cache' )
+	
+	pr_build.options['zip']    = 'v3'
+	pr_build.options['core']   = [ '1' ]
+	pr_build.options['levels'] = [ '1' ]
+	pr_build.options['number'] = [ '0001' ]
+	pr_build.options['quiet']  = '-q'
+	
+	for name, function, args in [
+		( 'build_client', pr_build.build_client, ( 0, ) ),
+		( 'build_server', pr_build.build_server, ( 0, ) ),
+		( 'full_installer', pr_build.full_installer, ( '0001', False ) ) ]:
+		
+		start = time.time()
+		function( *args )
+		elapsed = time.time() - start
+		
+		print '%16s %8.3fs %8.2fMB/s' % ( name, elapsed, size / 1048576.0 / max( elapsed, 0.000001 ) )
+		
+		record( '%s %s files %sMB' % ( name, files, size / 1048576 ), elapsed, files )
+	
+	pr_utils.delete( path=builds )
+
+def synthetic_repos( path, files, size ):
+	
+	# generating tens of gigabytes takes a while, keep the repos while
+	# the parameters that made them stay the same
+	stamp = os.path.join( path, 'synthetic.txt' )
+	key = '%s %s %s\n' % ( files, size, options['seed'] )
+	
+	if os.path.exists( stamp ) and open( stamp ).read() == key:
+		print '%10s files %8.1fMB reused from %s' % ( files, size / 1048576.0, path )
+		return
+	
+	start = time.time()
+	
+	pr_utils.delete( path=path )
+	os.makedirs( path )
+	
+	# a random block sliced at random offsets, incompressible like real
+	# textures and meshes without paying for random data on every byte
+	block = os.urandom( 2 ** 20 )
+	
+	# levels are few big files, the core is many small archive files
+	levels = max( files / 100, 1 )
+	core = max( files - levels, 1 )
+	
+	archives = []
+	for type in [ 'client', 'server' ]:
+		archives.extend( pr_build.core_archives['v3'][type].keys() )
+	archives.sort()
+	
+	for i in range( 0, core ):
+		p = os.path.join( 'core', os.path.normcase( archives[i % len( archives )] ) + '-zip', 'folder%s' % ( i / len( archives ) % 200 ), 'file%s.%s' % ( i, random.choice( [ 'con', 'tweak', 'dds', 'staticmesh' ] ) ) )
+		synthetic_file( os.path.join( path, p ), block, size * 2 / 5 / core )
+	
+	for i in range( 0, levels ):
+		p = os.path.join( 'levels', 'level%s' % ( i % 50 ), '%s%s.zip' % ( random.choice( [ 'client', 'server' ] ), i ) )
+		synthetic_file( os.path.join( path, p ), block, size * 3 / 5 / levels )
+	
+	for type, filecon in pr_build.archives_con.iteritems():
+		f = open( os.path.join( path, 'core', filecon ), 'w' )
+		f.write( 'rem patch\n' )
+		f.close()
+	
+	f = open( stamp, 'w' )
+	f.write( key )
+	f.close()
+	
+	print '%10s files %8.1fMB generated in %.1fs' % ( files, size / 1048576.0, time.time() - start )
+
+def synthetic_file( path, block, size ):
+	
+	folder = os.path.dirname( path )
+	if not os.path.exists( folder ):
+		os.makedirs( folder )
+	
+	f = open( path, 'wb' )
+	while size > 0:
+		n = min( size, len( block ) )
+		o = random.randint( 0, len( block ) - n )
+		f.write( block[o:o+n] )
+		size -= n
+	f.close()
+
+def record( name, elapsed, count ):
+	results.append( ( name, elapsed, count ) )
+
+def save_results( path ):
+	
+	# one line per benchmark and run: time, seconds, count, name
+	last = {}
+	if os.path.exists( path ):
+		for line in open( path ):
+			parts = line.rstrip( '\n' ).split( '\t' )
+			if len( parts ) == 4:
+				last[parts[3]] = float( parts[1] )
+	
+	print 'results'
+	
+	stamp = time.strftime( '%Y-%m-%d %H:%M:%S' )
+	
+	f = open( path, 'a' )
+	for name, elapsed, count in results:
+		
+		line = '%-40s %8.3fs' % ( name, elapsed )
+		if name in last:
+			ratio = elapsed / max( last[name], 0.000001 )
+			line += '   x%.2f of last run' % ratio
+			if ratio > regression and elapsed - last[name] > noise:
+				line += '   REGRESSION'
+		print line
+		
+		f.write( '%s\t%.3f\t%s\t%s\n' % ( stamp, elapsed, count, name ) )
+	f.close()
+
+def synthetic_xml( count, per_revision=20 ):
+	
+	xml = [ '<?xml version="1.0"?>\n<log>\n' ]
+	
+	for revision in range( 1, count + 1 ):
+		
+		xml.append( '<logentry revision="%s">\n<author>author%s</author>\n' % ( revision, revision % 7 ) )
+		xml.append( '<date>2008-04-%02dT12:%02d:00.000000Z</date>\n' % ( revision % 28 + 1, revision % 60 ) )
+		xml.append( '<paths>\n' )
+		for i in range( 0, random.randint( 1, per_revision ) ):
+			xml.append( '<path action="%s">%s</path>\n' % ( random.choice( 'AMD' ), synthetic_path( revision * per_revision + i ) ) )
+		xml.append( '</paths>\n<msg>FIX: synthetic change %s</msg>\n</logentry>\n' % revision )
+	
+	xml.append( '</log>\n' )
+	
+	return ''.join( xml )
+
+def synthetic_log( count, per_revision=500 ):
+	
+	# a few big level imports mixed with ordinary commits that touch,
+	# re-add and delete the same archive folders over and over
+	logs = []
+	paths = [ synthetic_path( i ) for i in range( 0, max( count / 4, 1 ) ) ]
+	
+	revision = 0
+	done = 0
+	while done < count:
+		
+		revision += 1
+		n = min( random.randint( 1, per_revision ), count - done )
+		
+		changed = []
+		for i in range( 0, n ):
+			changed.append( ( random.choice( 'AAMMMD' ), random.choice( paths ) ) )
+		
+		logs.append( { 'revision': str( revision ), 'paths': changed } )
+		done += n
+	
+	return logs
+
+def synthetic_path( i ):
+	
+	if i % 3 == 0:
+		return '/levels/level%s/objects_client-zip/file%s.con' % ( i % 50, i )
+	
+	# the same archive folders the build knows about
+	archives = pr_build.core_archives['v3']['server'].keys()
+	return '/trunk/%s-zip/folder%s/file%s.tweak' % ( archives[i % len( archives )], i % 400, i )
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -6,13 +6,23 @@ import getopt
 import os
 import os.path
 import stat
-import compileall
+import py_compile
+import imp
+import struct
+import hashlib
 import re
+import time
+import zipfile
+import threading
 
 from xml.dom import minidom
 
 from pr_utils import *
+import pr_utils
 import pr_svn
+import pr_zip
+import pr_trace
+import pr_store
 
 help_message = '''
 Project Reality Mod Build Generator
@@ -44,14 +54,22 @@ Other options:
 
 	-k --skip         skip to the last patch (must have all other builds ready)
 	-w --wait         pauses after each major subversion command
+	   --delay        sleeps 10 seconds after each rename (slow file systems)
 	-z --zip          zip structure (default v3)
 	-x --password     defines the password for a passworded installer
+	-j --jobs         number of parallel workers for archives (default cpu count)
+	   --copy         copy server and patch builds instead of hard linking them
+	   --dry          print the client build stages and critical path without building
+	                  anything (implies --verbose)
+	   --nostore      do not deduplicate the build trees into the content store
 
 	-y --python       do not compile python
 	-i --installer    do not create installers
 	-u --update       do not update the repo
 	-e --export       do not export the repo
 	-a --archive      do not compile archives
+	-f --force        rebuild all archives, bytecode and base exports ignoring
+	                  the caches, the archive and bytecode caches start empty
 	-m --merge        do not merge already compiled builds
 
 	-p --paths        core and levels repo subpaths additions to defaults (comma separated)
@@ -77,7 +95,28 @@ patch_build    = os.path.join( builds_path, 'patch' )
 core_build_patch   = os.path.join( builds_path, 'core_patch' )
 levels_build_patch = os.path.join( builds_path, 'levels_patch' )
 
-exec_7zip  = 'C:\\repos\\core\\readme\\assets\\7za.exe'
+cache_build    = os.path.join( builds_path, 'cache' )
+
+svn_lock   = threading.Lock()
+
+stage_workers = 3
+
+# content hashes of the archives this run built or reused from the cache
+archives_used = set()
+
+# process pool the stages share, forked before the stage threads start
+shared_pool = None
+
+# deleted paths of each patch export, waiting for the patch bat stage
+patch_deleted = {}
+
+# clientarchives.con / serverarchives.con as exported for each patch
+archives_source = {}
+
+# archives and unarchived archive folders of each core build, see manifest()
+manifests = {}
+manifests_lock = threading.RLock()
+
 exec_inno  = 'C:\\Program Files (x86)\\Inno Setup 5\\iscc.exe'
 
 installer_path    = os.path.join( core_path, 'readme', 'assets', 'builds', 'installer', 'pr_installer.iss' )
@@ -139,6 +178,16 @@ archives_con = {
 	'server': 'serverarchives.con'
 }
 
+# client only files left out of server builds, as
+# ( folder, patterns, recursive, exclude ) - client archives are added per patch
+server_exclusions = [
+	( 'levels', [ '*client.zip', '*.png' ], True, [] ),
+	( '', [ 'shaders_client_pr.zip', archives_con['client'], '00000000.256', 'pr.exe', 'pr_xp.exe', 'tr.exe', 'movies', 'patch' ], False, [] ),
+	( 'menu', [ 'external' ], False, [] ),
+	( 'readme', [ 'bf2editor', 'dotnet', 'icons' ], False, [] ),
+	( 'readme', [ '*.pdf', '*.txt' ], False, [ 'license.txt' ] ),
+]
+
 core_archives = {
 	'v1': {
 		'client': {
@@ -252,8 +301,10 @@ options = {
 	'test': False,
 	'skip': False,
 	'wait': False,
+	'delay': False,
 	'zip': 'v3',
 	'password': '',
+	'jobs': None,
 	'paths': [ 'trunk', 'levels' ],
 	
 	'python': True,
@@ -261,6 +312,10 @@ options = {
 	'update': True,
 	'export': True,
 	'archive': True,
+	'force': False,
+	'link': True,
+	'dry': False,
+	'store': True,
 	'cleanup': True,
 	'merge': True,
 	
@@ -274,6 +329,12 @@ class Usage(Exception):
 	def __init__(self, msg):
 		self.msg = msg
 
+class Stopped(Exception):
+	pass
+
+# set when a job run by concurrently() fails
+stopped = threading.Event()
+
 def main(argv=None):
 	global options
 	
@@ -282,9 +343,9 @@ def main(argv=None):
 	try:
 		try:
 			opts, args = getopt.getopt(argv[1:], 
-				"hc:l:o:n:bstkwp:z:x:yiueamvq", 
-				[ "help", "core=", "levels=", "localization=", "number=", "build", "server", "test", "skip", "wait", 
-					"paths=", "zip=", "password=", "python", "installer", "update", "export", "archive", "merge", "verbose", "quiet" ])
+				"hc:l:o:n:bstkwp:z:x:j:yiueafmvq", 
+				[ "help", "core=", "levels=", "localization=", "number=", "build", "server", "test", "skip", "wait", "delay", "copy", "dry", "nostore", 
+					"paths=", "zip=", "password=", "jobs=", "python", "installer", "update", "export", "archive", "force", "merge", "verbose", "quiet" ])
 		except getopt.error, msg:
 			raise Usage(msg)
 		
@@ -312,10 +373,24 @@ def main(argv=None):
 				options['skip'] = True
 			if option in ("-w", "--wait"):
 				options['wait'] = True
+			if option == "--delay":
+				options['delay'] = True
+			if option == "--copy":
+				options['link'] = False
+			if option == "--dry":
+				options['dry'] = True
+				options['verbose'] = '-v'
+			if option == "--nostore":
+				options['store'] = False
 			if option in ("-z", "--zip") and value in core_archives:
 				options['zip'] = value
 			if option in ("-x", "--password"):
 				options['password'] = value
+			if option in ("-j", "--jobs"):
+				try:
+					options['jobs'] = int( value )
+				except ValueError:
+					raise Usage('Number of jobs must be a number')
 			if option in ("-p", "--paths"):
 				paths = value.split(',')
 				for p in paths:
@@ -331,6 +406,8 @@ def main(argv=None):
 				options['export'] = False
 			if option in ("-a", "--archive"):
 				options['archive'] = False
+			if option in ("-f", "--force"):
+				options['force'] = True
 			if option in ("-m", "--merge"):
 				options['merge'] = False
 			
@@ -342,6 +419,9 @@ def main(argv=None):
 		if not options['verbose']:
 			options['quiet'] = '-q'
 		
+		pr_utils.rename_delay = options['delay']
+		pr_svn.log_cache = os.path.join( cache_build, 'svnlog.db' )
+		
 		if not options['core'] or not options['levels'] or not options['number']:
 			raise Usage('Missing required arguments')
 		
@@ -374,6 +454,11 @@ def main(argv=None):
 		
 		if options['build']:
 			
+			# --force starts the caches over instead of only bypassing them
+			if options['force'] and not options['dry']:
+				delete( path=os.path.join( cache_build, 'archives' ), verbose=options['verbose'] )
+				delete( path=os.path.join( cache_build, 'python' ), verbose=options['verbose'] )
+			
 			if options['skip']:
 				
 				verbose( 'SKIP BUILD' )
@@ -387,40 +472,54 @@ def main(argv=None):
 						raise Usage('Missing levels build %s' % path_levels_build( p ) )
 				
 				options['patch'] = patch
-				build_client( patch )
+				build_stages( patch, patch )
 				
 			else:
 				
 				verbose( 'FULL BUILD' )
-				for patch in range( 0, len( options['core'] ) ):
-					options['patch'] = patch
-					build_client( patch )
+				options['patch'] = len( options['core'] )-1
+				build_stages( 0, options['patch'] )
+		
+		# nothing past the plan runs, server and installers included
+		if options['dry']:
+			return 0
+		
+		if options['build']:
 			
 			if options['python']:
-				build_python( options['patch'] )
+				pr_trace.run( 'python', build_python, options['patch'] )
 		
 			if options['patch']:
-				build_patch( options['patch'] )
+				pr_trace.run( 'patch', build_patch, options['patch'] )
 		
 		if options['server']:
-			build_server( options['patch'] )
+			pr_trace.run( 'server', build_server, options['patch'] )
 		
 		if options['installer']:
 			
 			if options['build']:
 				
 				if len( options['core'] ) == 1:
-					full_installer( options['number'][-1], options['test'] )
+					pr_trace.run( 'installer', full_installer, options['number'][-1], options['test'] )
 				
 				else:
 					
-					patch_installer( options['number'][-1], options['number'][-2], options['test'] )
+					pr_trace.run( 'installer', patch_installer, options['number'][-1], options['number'][-2], options['test'] )
 					
 					if not options['skip']:
-						full_installer( options['number'][-1], options['test'] )
+						pr_trace.run( 'installer', full_installer, options['number'][-1], options['test'] )
 			
 			if options['server']:
-				server_installer( options['number'][-1], options['test'] )
+				pr_trace.run( 'installer', server_installer, options['number'][-1], options['test'] )
+		
+		# the store links build trees together, nothing may write through them after this
+		if options['store'] and options['link']:
+			pr_trace.run( 'store', store_builds, options['patch'] )
+		
+		if options['build']:
+			evict_archives()
+		
+		write_trace()
 		
 		verbose( 'DONE', True )
 	
@@ -428,112 +527,313 @@ def main(argv=None):
 		print >> sys.stderr, sys.argv[0].split("/")[-1] + ": " + str(err.msg)
 		# print >> sys.stderr, "\t for help use --help"
 		return 2
+	
+	except pr_svn.SvnError, err:
+		write_log( 'svn.txt', [ svn_line( c ) for c in pr_svn.commands ] )
+		write_trace()
+		print >> sys.stderr, sys.argv[0].split("/")[-1] + ": " + str(err.msg)
+		return 1
 
 def build_client( patch ):
 	
 	verbose( 'CLIENT BUILD %s' % patch )
 	
-	core_revision         = options['core'][patch]
-	levels_revision       = options['levels'][patch]
+	for name, function, args, deps in client_stages( patch, patch ):
+		function( *args )
+
+def client_stages( first, last ):
+	
+	# ( name, function, args, dependencies ) for every client build stage,
+	# dependencies outside first..last are taken as already built
+	stages = []
+	
+	for patch in range( first, last+1 ):
+		
+		# the working copies are shared, so an update waits for everything
+		# reading the previous revision out of them
+		stages.append( ( 'update %s' % patch, pr_trace.traced( 'update', stage_update ), ( patch, ), [ 'export %s' % ( patch-1 ), 'patch bat %s' % ( patch-1 ) ] ) )
+		stages.append( ( 'export %s' % patch, pr_trace.traced( 'export', stage_export ), ( patch, ), [ 'update %s' % patch ] ) )
+		stages.append( ( 'cleanup %s' % patch, pr_trace.traced( 'cleanup', stage_cleanup ), ( patch, ), [ 'export %s' % patch ] ) )
+		
+		# mounting and deleting patched archives looks at every earlier patch
+		# build, and at the core build once the earlier patches are merged
+		if patch:
+			stages.append( ( 'patch bat %s' % patch, pr_trace.traced( 'patch bat', stage_patch_bat ), ( patch, ), [ 'export %s' % patch, 'archive %s' % ( patch-1 ), 'merge %s' % ( patch-1 ) ] ) )
+		
+		stages.append( ( 'archive %s' % patch, pr_trace.traced( 'archive', stage_archive ), ( patch, ), [ 'cleanup %s' % patch, 'archive %s' % ( patch-1 ), 'merge %s' % ( patch-1 ) ] ) )
+		
+		if patch:
+			stages.append( ( 'merge %s' % patch, pr_trace.traced( 'merge', stage_merge ), ( patch, ), [ 'archive %s' % patch, 'patch bat %s' % patch, 'merge %s' % ( patch-1 ) ] ) )
+	
+	return stages
+
+def build_stages( first, last ):
+	
+	stages = client_stages( first, last )
+	
+	if options['dry']:
+		
+		verbose( 'BUILD PLAN' )
+		
+		names = [ s[0] for s in stages ]
+		for name, function, args, deps in stages:
+			verbose( '%-12s <- %s' % ( name, ', '.join( [ d for d in deps if d in names ] ) ), False )
+		
+		total, path = critical_path( stages, stage_weights( stages ) )
+		verbose( 'Critical path (%.0fs estimated): %s' % ( total, ' -> '.join( path ) ), False )
+		
+		return
+	
+	# --wait pauses for input, stages must run one at a time for it
+	if options['wait']:
+		workers = 1
+	else:
+		workers = stage_workers
+	
+	global shared_pool
+	
+	shared_pool = process_pool( options['jobs'] )
+	try:
+		timings = schedule( stages, workers )
+	except:
+		if shared_pool:
+			shared_pool.terminate()
+			shared_pool.join()
+		shared_pool = None
+		raise
+	
+	if shared_pool:
+		shared_pool.close()
+		shared_pool.join()
+	shared_pool = None
+	
+	total, path = critical_path( stages, timings )
+	verbose( 'Critical path %.2fs: %s' % ( total, ' -> '.join( path ) ), False )
+	
+	write_log( 'stages.txt', [ '%10.2f %s' % ( timings[s[0]], s[0] ) for s in stages ] )
+
+def stage_weights( stages ):
+	
+	# average seconds per stage kind (update, archive...) in the last run,
+	# one second for kinds never timed
+	times = {}
+	
+	f = os.path.join( logs_path, 'stages.txt' )
+	if os.path.exists( f ):
+		for line in open( f ):
+			try:
+				seconds, name = line.split( None, 1 )
+				times.setdefault( name.strip().rsplit( ' ', 1 )[0], [] ).append( float( seconds ) )
+			except ValueError:
+				continue
+	
+	weights = {}
+	for s in stages:
+		kind = s[0].rsplit( ' ', 1 )[0]
+		if kind in times:
+			weights[s[0]] = sum( times[kind] ) / len( times[kind] )
+		else:
+			weights[s[0]] = 1.0
+	
+	return weights
+
+def stage_update( patch ):
+	
+	if not options['update']:
+		return
+	
+	verbose( 'REPO UPDATE %s' % patch )
+	
+	concurrently( [ ( update_core, ( patch, ) ), ( update_repo, ( levels_path, options['levels'][patch] ) ) ] )
+	wait()
+
+def update_core( patch ):
+	
+	# localization is a working copy inside core, never updated alongside it
+	update_repo( core_path, options['core'][patch] )
+	
+	if options['localization']:
+		update_repo( localization_path, options['localization'][patch] )
+
+def stage_export( patch ):
+	
+	if not options['export']:
+		return
+	
+	verbose( 'REPO EXPORT %s' % patch )
+	
+	cb = path_core_build( patch )
+	lb = path_levels_build( patch )
+	
+	delete( path=cb, verbose=options['verbose'] )
+	delete( path=lb, verbose=options['verbose'] )
+	forget_manifest( patch )
+	
+	concurrently( [ ( export_core, ( patch, cb ) ), ( export_levels, ( patch, lb ) ) ] )
+	wait()
+
+def stage_cleanup( patch ):
+	
+	if not options['export'] or not options['cleanup']:
+		return
+	
+	verbose( 'CLEANUP %s' % patch )
 	
 	cb = path_core_build( patch )
 	lb = path_levels_build( patch )
 	
+	removed = []
+	
+	delete( path=os.path.join( cb, 'build_pr.bat' ), verbose=options['verbose'] )
+	delete( path=os.path.join( cb, 'readme', 'assets' ), verbose=options['verbose'] )
+	removed.extend( prune( cb, 'bst*.md5', False, [], False, options['verbose'] ) )
+	removed.extend( prune( lb, [ 'assets', 'server' ], True, [], False, options['verbose'] ) )
+	removed.extend( clean_archives( cb, core_archives[options['zip']]['server'] ) )
+	removed.extend( clean_archives( cb, core_archives[options['zip']]['client'] ) )
+	empty_archives( cb, options['core'][patch] )
+	clean_atlas( cb )
+	removed.extend( clean_levels( lb ) )
+	
+	write_log( 'cleanup%s.txt' % patch_sufix( patch ), removed )
+
+def stage_patch_bat( patch ):
+	
+	if patch in patch_deleted:
+		build_patch_bat( patch, patch_deleted.pop( patch ) )
+
+def stage_archive( patch ):
+	
+	if not options['archive']:
+		return
+	
+	verbose( 'ARCHIVE %s' % patch )
+	
+	cb = path_core_build( patch )
+	sufix = patch_sufix( patch )
+	
+	build_archives( cb, core_archives[options['zip']]['server'], sufix )
+	build_archives( cb, core_archives[options['zip']]['client'], sufix )
+	rename( os.path.join( cb, 'shaders_client.zip' ), os.path.join( cb, 'shaders_client_pr.zip' ), options['verbose'] )
+	delete_archives( cb, core_archives[options['zip']]['server'] )
+	delete_archives( cb, core_archives[options['zip']]['client'] )
+	
+	forget_manifest( patch )
+	manifest( patch, True )
+	
+	update_archives( patch )
+
+def stage_merge( patch ):
+	
+	if not options['merge'] or not patch:
+		return
+	
+	verbose( 'MERGE PATCH %s' % patch )
+	
+	merge( path_core_build( patch ), core_build,   options['verbose'] )
+	merge( path_levels_build( patch ), levels_build, options['verbose'] )
+	apply_patch( core_build )
+	forget_manifest( 0 )
+
+def patch_sufix( patch ):
+	
 	if not patch:
-		sufix = ''
-	else:
-		sufix = '_patch%s' % patch
+		return ''
 	
-	if options['update']:
-		verbose( 'REPO UPDATE %s' % patch )
-		
-		update_repo( core_path, core_revision )
-		update_repo( levels_path, levels_revision )
+	return '_patch%s' % patch
+
+def export_core( patch, cb ):
+	
+	core_revision = options['core'][patch]
+	
+	if not patch:
+		export_base( core_path, cb, core_revision, 'core' )
+	
+	else:
 		
-		if options['localization']:
-			update_repo( localization_path, options['localization'][patch] )
+		core_lrevision = int( options['core'][patch-1] )+1
 		
-	if options['export']:
-		verbose( 'REPO EXPORT %s' % patch )
+		if core_lrevision <= int( core_revision ):
+			core_log = log_repo( core_path, core_lrevision, core_revision )
+			added, modified, deleted = paths_repo( core_log, options['paths'] )
+			paths = []
+			paths.extend(added)
+			paths.extend(modified)
+			for path in paths:
+				copy( os.path.join( core_path, path ), os.path.join( cb, path ), options['verbose'] )
+			patch_deleted[patch] = deleted
 		
-		delete( path=cb, verbose=options['verbose'] )
-		delete( path=lb, verbose=options['verbose'] )
+		for type in ['server','client']:
+			for p,o in core_archives[options['zip']][type].iteritems():
+				if not o[0]:
+					delete( path='%s-zip' % os.path.join( cb, os.path.normcase( p ) ), verbose=options['verbose'] )
+					copy( '%s-zip' % os.path.join( core_path, os.path.normcase( p ) ), '%s-zip' % os.path.join( cb, os.path.normcase( p ) ), options['verbose'] )
+	
+	# the archive stage may run after the working copy moved on to the next patch
+	archives_source[patch] = {}
+	for type,filecon in archives_con.iteritems():
+		if os.path.exists( os.path.join( core_path, filecon ) ):
+			archives_source[patch][filecon] = open( os.path.join( core_path, filecon ) ).read()
+	
+	# localization lives inside the core build, so it follows the core export
+	if options['localization']:
+		delete( path=os.path.join( cb, 'localization'), verbose=options['verbose'] )
+		export_repo( localization_path, os.path.join( cb, 'localization') )
+
+def export_levels( patch, lb ):
+	
+	levels_revision = options['levels'][patch]
+	
+	if not patch:
+		export_base( levels_path, lb, levels_revision, 'levels' )
+	
+	else:
 		
-		if not patch:
-			
-			export_repo( core_path, cb )
-			export_repo( levels_path, lb )
+		levels_lrevision = int( options['levels'][patch-1] )+1
 		
-		else:
-			
-			core_lrevision   = int( options['core'][patch-1] )+1
-			levels_lrevision = int( options['levels'][patch-1] )+1
-			
-			if core_lrevision <= int( core_revision ):
-				core_log = log_repo( core_path, core_lrevision, core_revision )
-				added, modified, deleted = paths_repo( core_log, options['paths'] )
-				paths = []
-				paths.extend(added)
-				paths.extend(modified)
-				for path in paths:
-					copy( os.path.join( core_path, path ), os.path.join( cb, path ), options['verbose'] )
-				build_patch_bat( patch, deleted )
-			
-			if levels_lrevision <= int( levels_revision ):
-				levels_log = log_repo( levels_path, levels_lrevision, levels_revision )
-				added, modified, deleted = paths_repo( levels_log, options['paths'] )
-				paths = []
-				paths.extend(added)
-				paths.extend(modified)
-				for path in paths:
-					copy( os.path.join( levels_path, path ), os.path.join( lb, path ), options['verbose'] )
-			
-			if options['test']:
-				for level in test_levels:
-					delete( path=lb, pattern=level, recursive=True, verbose=options['verbose'] )
-					export_repo( os.path.join( levels_path, level ), lb )
-			
-			for type in ['server','client']:
-				for p,o in core_archives[options['zip']][type].iteritems():
-					if not o[0]:
-						delete( path='%s-zip' % os.path.join( cb, os.path.normcase( p ) ), verbose=options['verbose'] )
-						copy( '%s-zip' % os.path.join( core_path, os.path.normcase( p ) ), '%s-zip' % os.path.join( cb, os.path.normcase( p ) ), options['verbose'] )
-		
-		if options['localization']:
-			delete( path=os.path.join( cb, 'localization'), verbose=options['verbose'] )
-			export_repo( localization_path, os.path.join( cb, 'localization') )
-		
-		if options['cleanup']:
-			verbose( 'CLEANUP %s' % patch )
-			
-			delete( path=os.path.join( cb, 'build_pr.bat' ), verbose=options['verbose'] )
-			delete( path=os.path.join( cb, 'readme', 'assets' ), verbose=options['verbose'] )
-			delete( path=cb, pattern='bst*.md5', verbose=options['verbose'] )
-			delete( path=lb, pattern='assets', recursive=True, verbose=options['verbose'] )
-			delete( path=lb, pattern='server', recursive=True, verbose=options['verbose'] )
-			clean_archives( cb, core_archives[options['zip']]['server'] )
-			clean_archives( cb, core_archives[options['zip']]['client'] )
-			empty_archives( cb, core_revision )
-			clean_atlas( cb )
-			clean_levels( lb )
-	
-	if options['archive']:
-		verbose( 'ARCHIVE %s' % patch )
-		
-		build_archives( cb, core_archives[options['zip']]['server'], sufix )
-		build_archives( cb, core_archives[options['zip']]['client'], sufix )
-		rename( os.path.join( cb, 'shaders_client.zip' ), os.path.join( cb, 'shaders_client_pr.zip' ), options['verbose'] )
-		delete_archives( cb, core_archives[options['zip']]['server'] )
-		delete_archives( cb, core_archives[options['zip']]['client'] )
-		update_archives( patch )
-	
-	if options['merge'] and patch:
-		verbose( 'MERGE PATCH %s' % patch )
-		
-		merge( cb, core_build,   options['verbose'] )
-		merge( lb, levels_build, options['verbose'] )
-		run_patch_bat( core_build )
+		if levels_lrevision <= int( levels_revision ):
+			levels_log = log_repo( levels_path, levels_lrevision, levels_revision )
+			added, modified, deleted = paths_repo( levels_log, options['paths'] )
+			paths = []
+			paths.extend(added)
+			paths.extend(modified)
+			for path in paths:
+				copy( os.path.join( levels_path, path ), os.path.join( lb, path ), options['verbose'] )
 		
+		if options['test']:
+			for level in test_levels:
+				delete( path=lb, pattern=level, recursive=True, verbose=options['verbose'] )
+				export_repo( os.path.join( levels_path, level ), lb )
+
+def concurrently( jobs ):
+	
+	# core and levels are independent repos, the first failure stops the
+	# other jobs before their next svn command and is raised once they
+	# have stopped
+	stopped.clear()
+	errors = []
+	
+	def run( job ):
+		try:
+			job[0]( *job[1] )
+		except Stopped:
+			pass
+		except:
+			stopped.set()
+			errors.append( sys.exc_info() )
+	
+	try:
+		pool( run, jobs, len( jobs ) )
+	finally:
+		stopped.clear()
+	
+	if errors:
+		raise errors[0][0], errors[0][1], errors[0][2]
+
+def check_stopped():
+	
+	if stopped.isSet():
+		raise Stopped()
+
 def build_python( patch ):
 	
 	verbose( 'PYTHON BUILD %s' % patch )
@@ -541,37 +841,56 @@ def build_python( patch ):
 	delete( path=os.path.join( core_build, 'python', 'game' ), verbose=options['verbose'] )
 	export_repo( os.path.join( core_path, 'python', 'game' ), os.path.join( core_build, 'python', 'game' ) )
 	compile_python( os.path.join( core_build, 'python', 'game' ) )
-	clean_python( os.path.join( core_build, 'python' ) )
+	write_log( 'python.txt', clean_python( os.path.join( core_build, 'python' ) ) )
 	
 	if patch:
 		delete( path=os.path.join( path_core_build( patch ), 'python', 'game' ), verbose=options['verbose'] )
 		copy( os.path.join( core_build, 'python', 'game' ), os.path.join( path_core_build( patch ), 'python', 'game' ), options['verbose'] )
 
-def run_patch_bat( path ):
+def apply_patch( path ):
 
-	verbose( 'PATCH BAT RUN' )
+	verbose( 'PATCH RUN' )
 	
-	if not os.path.exists( os.path.join( path, 'patch', 'patch.bat' ) ):
+	pb = os.path.join( path, 'patch' )
+	
+	if not os.path.exists( os.path.join( pb, 'patch_plan.txt' ) ):
 		return
 	
-	root = os.getcwd()
+	# what patch.bat does, on every os, with the zip entries removed in
+	# process and the archives rewritten in parallel
+	archives = []
 	
-	os.chdir( os.path.join( path, 'patch' ) )
-	if os.name not in ['posix','mac']:
-		if options['quiet']:
-			q = '> nul'
-		else:
-			q = ''
-		os.system( '"patch.bat" %s' % ( q ) )
+	for line in open( os.path.join( pb, 'patch_plan.txt' ) ):
+		
+		line = line.rstrip( '\r\n' ).split( '\t' )
+		
+		if line[0] == 'delete':
+			delete( path=os.path.join( path, os.path.normpath( line[1] ) ), verbose=options['verbose'] )
+		
+		if line[0] == 'remove':
+			archives.append( ( os.path.join( path, os.path.normpath( line[1] ) ), os.path.join( pb, line[2] ) ) )
 	
-	os.chdir( root )
+	failed = []
 	
-	if os.path.exists( os.path.join( path, 'patch_error.dat' ) ):
-		sys.exit( 'Patch bat failed to run, see patch.log' )
-	else:
-		delete( path=os.path.join( path, 'patch.log' ), verbose=options['verbose'] )
-		delete( path=os.path.join( path, 'patch_error.dat' ), verbose=options['verbose'] )
-		delete( path=os.path.join( path, 'patch' ), verbose=options['verbose'] )
+	for archive, removed, error in pool( remove_entries, archives ):
+		if error:
+			failed.append( '%s: %s' % ( archive, error ) )
+		elif removed:
+			verbose( 'Removed %s entries from %s' % ( removed, archive ), False )
+	
+	if failed:
+		sys.exit( 'Failed to patch archives:\n\t%s' % '\n\t'.join( sorted( failed ) ) )
+	
+	delete( path=pb, verbose=options['verbose'] )
+
+def remove_entries( job ):
+	
+	archive, listing = job
+	
+	try:
+		return archive, pr_zip.remove( archive, open( listing ).read().splitlines() ), None
+	except ( IOError, OSError, zipfile.error, zipfile.LargeZipFile ), e:
+		return archive, 0, str( e ) or e.__class__.__name__
 
 def build_patch_bat( patch, deleted ):
 	
@@ -592,6 +911,9 @@ def build_patch_bat( patch, deleted ):
 	c = 0
 	s = ''
 	
+	# the same steps for apply_patch, one per line
+	plan = []
+	
 	regex = re.compile('^.*(python|assets)%s.*$' % os.sep, re.I)
 	
 	zips = {}
@@ -612,6 +934,8 @@ def build_patch_bat( patch, deleted ):
 			else:
 				s = s + 'del /F /Q "..\\%s"%s' % ( w, nl )
 			
+			plan.append( 'delete\t%s' % path.replace( os.sep, '/' ) )
+			
 		else:
 			
 			z = path[0:path.find('-zip')].replace(os.sep, '/')
@@ -654,17 +978,22 @@ def build_patch_bat( patch, deleted ):
 			t.write(p + nl)
 		t.close()
 		
+		files, folders = pr_zip.selection( ps )
+		
 		for a in range(0,patch):
 			
 			if a:
 				zz = '%s_patch%s.zip' % (z, a)
 				
 				exists = False
+				entries = None
 				for b in range(0,a+1):
-					if os.path.exists( os.path.join( path_core_build(b), zz ) ):
+					m = manifest( b )
+					if zz.replace( os.sep, '/' ) in m['zips']:
 						exists = True
+						entries = m['zips'][zz.replace( os.sep, '/' )]
 						break
-					if b and os.path.exists( os.path.join( path_core_build(b), '%s-zip' % z ) ):
+					if b and z.replace( os.sep, '/' ) in m['folders']:
 						exists = True
 						break
 				
@@ -673,6 +1002,15 @@ def build_patch_bat( patch, deleted ):
 			
 			else:
 				zz = '%s.zip' % z
+				entries = manifest( 0 )['zips'].get( zz.replace( os.sep, '/' ) )
+			
+			# archives known to hold none of the entries are left alone. Only
+			# the names decide that, crcs are checked against the archive
+			# itself when apply_patch rewrites it.
+			if entries is not None and not [ e for e in entries if pr_zip.matched( e[0], files, folders ) ]:
+				continue
+			
+			plan.append( 'remove\t%s\t%s' % ( zz.replace( os.sep, '/' ), l ) )
 			
 			zz = zz.replace('/', '\\')
 			
@@ -692,6 +1030,11 @@ def build_patch_bat( patch, deleted ):
 	f.write( 'ECHO ERROR - PATCH FAILED > %s%s' % ( pe, nl ) )
 	f.write( '%s:quit%s%s' % ( nl, nl, nl ) )
 	f.close()
+	
+	f = open( os.path.join( pb, 'patch_plan.txt' ), 'w' )
+	for line in plan:
+		f.write( line + '\n' )
+	f.close()
 
 def build_patch( patch ):
 	
@@ -699,8 +1042,8 @@ def build_patch( patch ):
 	
 	if options['merge']:
 		delete( path=patch_build, verbose=options['verbose'] )
-		merge( path_core_build( patch ),   patch_build, options['verbose'] )
-		merge( path_levels_build( patch ), os.path.join( patch_build, 'levels' ), options['verbose'] )
+		merge( path_core_build( patch ),   patch_build, options['verbose'], options['link'] )
+		merge( path_levels_build( patch ), os.path.join( patch_build, 'levels' ), options['verbose'], options['link'] )
 
 def build_server( patch ):
 	
@@ -709,46 +1052,80 @@ def build_server( patch ):
 	if options['merge']:
 		
 		delete( path=server_build, verbose=options['verbose'] )
-		merge( core_build,   server_build, options['verbose'] )
-		merge( levels_build, os.path.join( server_build, 'levels' ), options['verbose'] )
-	
-		verbose( 'SERVER CLEANUP' )
-
-		delete( os.path.join( server_build, 'levels' ), '*client.zip', True, [], options['verbose'] )
-		delete( os.path.join( server_build, 'levels' ), '*.png',       True, [], options['verbose'] )
-
-		for p,o in core_archives[options['zip']]['client'].iteritems():
-			delete( path=os.path.join( server_build, '%s.zip' % os.path.normcase( p ) ), verbose=options['verbose'] )
-			for i in range( 1, patch+1 ):
-				delete( path=os.path.join( server_build, '%s_patch%s.zip' % ( os.path.normcase( p ), i ) ), verbose=options['verbose'] )
-	
-		delete( path=os.path.join( server_build, 'shaders_client_pr.zip' ), verbose=options['verbose'] )
-		delete( path=os.path.join( server_build, archives_con['client'] ), verbose=options['verbose'] )
-		delete( path=os.path.join( server_build, 'menu', 'external' ), verbose=options['verbose'] )
-		delete( path=os.path.join( server_build, 'readme', 'bf2editor' ), verbose=options['verbose'] )
-		delete( path=os.path.join( server_build, 'readme', 'dotnet' ), verbose=options['verbose'] )
-		delete( path=os.path.join( server_build, 'readme', 'icons' ), verbose=options['verbose'] )
-		delete( path=os.path.join( server_build, 'readme' ), pattern='*.pdf', verbose=options['verbose'] )
-		delete( path=os.path.join( server_build, 'movies' ), verbose=options['verbose'] )
-		delete( path=os.path.join( server_build, '00000000.256' ), verbose=options['verbose'] )
-		delete( path=os.path.join( server_build, 'pr.exe' ), verbose=options['verbose'] )
-		delete( path=os.path.join( server_build, 'pr_xp.exe' ), verbose=options['verbose'] )
-		delete( path=os.path.join( server_build, 'tr.exe' ), verbose=options['verbose'] )
-		delete( path=os.path.join( server_build, 'patch' ), verbose=options['verbose'] )
-		delete( os.path.join( server_build, 'readme' ), '*.txt', False, ['license.txt'], options['verbose'] )
+		
+		# client only files are filtered out while merging, never written
+		exclude = server_exclude( patch )
+		
+		merge( core_build,   server_build, options['verbose'], options['link'], exclude )
+		merge( levels_build, os.path.join( server_build, 'levels' ), options['verbose'], options['link'], 
+			lambda path, source: exclude( os.path.join( 'levels', path ), source ) )
+		
+		report = exclude.report()
+		verbose( 'Server exclusions saved %s' % report[-1].strip(), False )
+		write_log( 'server.txt', report )
 	
 		# rename( os.path.join( server_build, 'settings', 'prserverusersettings.con' ), os.path.join( server_build, 'settings', 'usersettings.con' ), options['verbose'] )
 		# os.chmod( os.path.join( server_build, 'settings', 'usersettings.con' ), stat.S_IREAD )
 	
+def server_exclude( patch ):
+	
+	rules = []
+	
+	for p,o in core_archives[options['zip']]['client'].iteritems():
+		
+		folder, name = os.path.split( p )
+		
+		archives = [ '%s.zip' % name ]
+		for i in range( 1, patch+1 ):
+			archives.append( '%s_patch%s.zip' % ( name, i ) )
+		
+		rules.append( ( folder, archives, False, [] ) )
+	
+	return Filter( rules + server_exclusions )
+
+def store_builds( patch ):
+	
+	verbose( 'STORE %s' % patch )
+	
+	if not pr_utils.hard_links:
+		verbose( 'No hard links on this os, the store is skipped', False )
+		return
+	
+	store = os.path.join( cache_build, 'store' )
+	
+	trees = [ core_build, levels_build ]
+	for i in range( 1, patch+1 ):
+		trees.append( path_core_build( i ) )
+		trees.append( path_levels_build( i ) )
+	trees.extend( [ server_build, patch_build ] )
+	
+	known = pr_store.load( store )
+	hashes = set()
+	lines = []
+	
+	for tree in trees:
+		
+		if not os.path.exists( tree ):
+			continue
+		
+		h, files, shared = pr_store.put( store, tree, known )
+		hashes.update( h )
+		
+		lines.append( '%10.1f MB shared %6s files  %s' % ( shared / 1048576.0, files, tree ) )
+	
+	# only the current patch chain keeps its objects
+	removed, freed = pr_store.gc( store, hashes )
+	lines.append( '%10.1f MB freed  %6s objects removed' % ( freed / 1048576.0, removed ) )
+	
+	for line in lines:
+		verbose( line, False )
+	
+	write_log( 'store.txt', lines )
+
 def server_installer( current, test ):
 	
 	verbose( 'SERVER INSTALLER %s TEST %s' % ( current, test ) )
 	
-	if test:
-		server_build_renamed = os.path.join( builds_path, 'pr_test' )
-	else:
-		server_build_renamed = os.path.join( builds_path, 'pr' )
-	
 	if test:
 		sufix = '_test'
 	else:
@@ -756,88 +1133,61 @@ def server_installer( current, test ):
 	
 	filename = os.path.join( builds_path, 'pr_%s%s_server.zip' % ( current, sufix ) )
 	
-	delete( path=server_build_renamed, verbose=options['verbose'] )
-	
-	rename( server_build, server_build_renamed, options['verbose'] )
 	delete( path=filename, verbose=options['verbose'] )
-	zip( server_build_renamed, filename, True )
-	rename( server_build_renamed, server_build, options['verbose'] )
+	zip( server_build, filename, True, 'pr%s' % sufix )
 
 def full_installer( current, test ):
 
 	verbose( 'FULL INSTALLER %s TEST %s' % ( current, test ) )
 	
-	part = 1
-	size = 0
-	
-	verbose( 'Generating Part 1' )
-	delete( path=os.path.join( '%s%s' % ( full_build, part ) ), verbose=options['verbose'] )
-	
 	paths = (
 		( core_build, '' ), 
 		( levels_build, 'levels' ),
 	)
 	
-	done = []
+	# one walk for the whole size index: ( size, full path, installer path )
+	index = []
 	total = 0
-	count = 0
-	
-	max   = 0
-	max_path = None
 	
 	for p in paths:
 		path,sub = p
 		
-		for root, dirs, files in os.walk( path, topdown=False ):
+		for root, dirs, files in os.walk( path ):
+			
+			sub_path = os.path.join( sub, root[len( path ):].strip(os.sep) )
 			
 			for file in files:
 				
-				fs = os.path.getsize(os.path.join(root,file))
-				if fs > max:
-					max = fs
-					max_path = os.path.join(root,file)
+				full_path = os.path.join( root, file )
+				fs = os.path.getsize( full_path )
 				
+				index.append( ( fs, full_path, os.path.join( sub_path, file ) ) )
 				total += fs
-				count += 1
 	
 	limit = int( total / 3.0 ) + ( 10 ** 8 )
 	if limit > 2 * ( 10 ** 9 ):
 		limit = 2 * ( 10 ** 9 )
 	
-	if max > limit:
-		sys.exit( '%s is larger than installer maximum filesize' % max_path )
+	if index:
+		largest = max( index )
+		if largest[0] > limit:
+			sys.exit( '%s is larger than installer maximum filesize' % largest[1] )
 	
-	while len( done ) < count:
+	parts = bins( index, limit )
+	part = max( len( parts ), 1 )
+	
+	for p in range( 1, part+1 ):
 		
-		for p in paths:
-			path,sub = p
+		verbose( 'Generating Part %s' % p )
 		
-			for root, dirs, files in os.walk( path, topdown=False ):
-			
-				for file in files:
-					
-					full_path = os.path.join( root, file )
-					if full_path in done:
-						continue
-					
-					s = os.path.getsize( full_path )
-					if size + s > limit:
-						continue
-				
-					size += s
-				
-					sub_path = root.replace( path, '' )
-					sub_path = sub_path.strip(os.sep)
-					sub_path = os.path.join( sub, sub_path, file )
-					copy( full_path, os.path.join( '%s%s' % ( full_build, part ), sub_path ) )
-					done.append( full_path )
+		destination = '%s%s' % ( full_build, p )
+		delete( path=destination, verbose=options['verbose'] )
 		
-		if len( done ) < count:
-			
-			part += 1
-			size = 0
-			verbose( 'Generating Part %s' % part )
-			delete( path=os.path.join( '%s%s' % ( full_build, part ) ), verbose=options['verbose'] )
+		if not os.path.exists( destination ):
+			os.makedirs( destination )
+		
+		if p <= len( parts ):
+			stage( [ ( full_path, os.path.join( destination, sub_path ) ) for fs, full_path, sub_path in parts[p-1] ], options['verbose'] )
 	
 	for p in range( 1, part+1 ):
 		client_installer( 'full%s' % p, current, None, test )
@@ -879,6 +1229,7 @@ def client_installer( type, current, previous=None, test=False):
 	args.append( '"%s"' % os.path.abspath( installer_path ) )
 	
 	os.spawnv(os.P_WAIT, exec_inno, args)
+	pr_trace.count( subprocesses=1 )
 	
 def path_core_build( patch ):
 	if patch:
@@ -894,14 +1245,78 @@ def path_levels_build( patch ):
 
 def update_repo( path, revision ):
 	
+	check_stopped()
 	verbose( 'Updating %s to revision %s' % ( path, revision ), False )
-	pr_svn.update( path, revision, options['quiet'] )
-	wait()
+	since = len( pr_svn.commands )
+	if pr_svn.update( path, revision, options['quiet'], repo_log( 'update', path ) ):
+		sys.exit( 'Updating %s failed, see svn.txt' % path )
+	svn_timing( path, since )
 
 def export_repo( path, destination ):
 	
+	check_stopped()
 	verbose( 'Exporting %s to %s' % ( path, destination ), False )
-	pr_svn.export( path, destination, options['quiet'] )
+	since = len( pr_svn.commands )
+	if pr_svn.export( path, destination, options['quiet'], repo_log( 'export', path ) ):
+		sys.exit( 'Exporting %s failed, see svn.txt' % path )
+	svn_timing( path, since )
+
+def export_base( path, destination, revision, name ):
+	
+	# keeps the last base export and its revision under the cache, and
+	# brings it forward with the same collapsed log paths a patch uses.
+	# Without --update the working copy is at no known revision, the cache
+	# is exported in full and left without one.
+	cache = os.path.join( cache_build, 'export', name )
+	stamp = cache + '.revision'
+	
+	current = None
+	if os.path.exists( cache ) and os.path.exists( stamp ):
+		try:
+			current = int( open( stamp ).read().strip() )
+		except ValueError:
+			pass
+	
+	try:
+		revision = int( revision )
+	except ValueError:
+		revision = None
+	
+	if not options['update']:
+		revision = None
+	
+	delete( path=stamp )
+	
+	if current is None or revision is None or current > revision or options['force']:
+		
+		verbose( 'Full export of %s to %s' % ( path, cache ), False )
+		
+		delete( path=cache, verbose=options['verbose'] )
+		export_repo( path, cache )
+	
+	elif current < revision:
+		
+		log = log_repo( path, current + 1, revision )
+		added, modified, deleted = paths_repo( log, options['paths'] )
+		
+		verbose( 'Export cache %s %s to %s: %s added, %s modified, %s deleted' % ( name, current, revision, len( added ), len( modified ), len( deleted ) ), False )
+		
+		for p in deleted:
+			delete( path=os.path.join( cache, p ), verbose=options['verbose'] )
+		
+		for p in added + modified:
+			copy( os.path.join( path, p ), os.path.join( cache, p ), options['verbose'] )
+	
+	else:
+		verbose( 'Export cache %s already at revision %s' % ( name, revision ), False )
+	
+	if revision is not None and os.path.exists( cache ):
+		f = open( stamp, 'w' )
+		f.write( '%s\n' % revision )
+		f.close()
+	
+	# a real copy, cleanup and the patch bat must never touch the cache
+	copy( cache, destination, options['verbose'] )
 
 def log_repo( path, start, end ):
 	
@@ -910,16 +1325,48 @@ def log_repo( path, start, end ):
 	else:
 		revision = end
 	
+	check_stopped()
 	verbose( 'Log %s revision %s' % ( path, revision ), False )
 	
+	since = len( pr_svn.commands )
 	logs = pr_svn.log( path, revision, True, True )
-	wait()
+	svn_timing( path, since )
 	
 	return logs
 
 def paths_repo( log, remove=['trunk'] ):
 	return pr_svn.get_paths( log, remove )
 
+def repo_log( action, path ):
+	
+	if not os.path.exists( logs_path ):
+		makedirs( logs_path )
+	
+	return os.path.join( logs_path, 'svn_%s_%s.txt' % ( action, os.path.basename( os.path.normpath( path ) ) ) )
+
+def svn_timing( path, since ):
+	
+	svn_lock.acquire()
+	try:
+		
+		for c in pr_svn.commands[since:]:
+			if path in c['command']:
+				verbose( '%s %s finished in %.2fs with status %s' % ( ' '.join( c['command'][0:2] ), path, c['time'], c['status'] ), False )
+		
+		write_log( 'svn.txt', [ svn_line( c ) for c in pr_svn.commands ] )
+	
+	finally:
+		svn_lock.release()
+
+def svn_line( c ):
+	
+	line = '%8.2fs status %s %s' % ( c['time'], c['status'], ' '.join( c['command'] ) )
+	
+	if c['stderr']:
+		line += '\n' + c['stderr'].strip()
+	
+	return line
+
 def empty_archives( path, revision ):
 	
 	for rev,paths in old_archives[options['zip']].iteritems():
@@ -933,7 +1380,9 @@ def empty_archives( path, revision ):
 				os.makedirs( os.path.join( dir, os.path.normcase( d ) ) )
 
 def clean_archives( path, archives ):
-
+	
+	removed = []
+	
 	for p,o in archives.iteritems():
 		
 		dir  = os.path.join( path, '%s-zip'   % ( os.path.normcase( p ) ) )
@@ -943,29 +1392,20 @@ def clean_archives( path, archives ):
 		
 		verbose( 'Cleaning %s' % ( dir ), False )
 		
-		delete( path=dir, pattern='assets',      recursive=True, verbose=options['verbose'] )
-		delete( path=dir, pattern='*.db',        recursive=True, verbose=options['verbose'] )
-		delete( path=dir, pattern='*.samp*',     recursive=True, verbose=options['verbose'] ) 
-		delete( path=dir, pattern='*.max',       recursive=True, verbose=options['verbose'] )
-		delete( path=dir, pattern='*.3ds',       recursive=True, verbose=options['verbose'] )
-		delete( path=dir, pattern='*.psd',       recursive=True, verbose=options['verbose'] )
-		delete( path=dir, pattern='*.bak',       recursive=True, verbose=options['verbose'] )
-		delete( path=dir, pattern='samples.tga', recursive=True, verbose=options['verbose'] )
-		delete( path=dir, pattern='uvs.tga',     recursive=True, verbose=options['verbose'] )
+		patterns = [ 'assets', '*.db', '*.samp*', '*.max', '*.3ds', '*.psd', '*.bak', 'samples.tga', 'uvs.tga' ]
 		
 		if p in filter_archives[options['zip']]:
-			for f in filter_archives[options['zip']][p]:
-				delete( path=dir, pattern=f, recursive=True, verbose=options['verbose'] )
-		
-		verbose( 'Deleting empty folders from %s' % ( dir ), False )
+			patterns.extend( filter_archives[options['zip']][p] )
 		
-		for root, dirs, files in os.walk( dir, topdown=False ):
-			for name in dirs:
-				if len( os.listdir(os.path.join(root, name)) ) == 0:
-					os.rmdir(os.path.join(root, name))
+		# empty subfolders go, the archive folder itself always stays
+		removed.extend( prune( dir, patterns, True, [], True, options['verbose'] ) )
+	
+	return removed
 
 def build_archives( path, archives, sufix='' ):
 	
+	jobs = []
+	
 	for p,o in archives.iteritems():
 		
 		dir  = os.path.join( path, '%s-zip'   % ( os.path.normcase( p ) ) )
@@ -979,53 +1419,271 @@ def build_archives( path, archives, sufix='' ):
 			continue
 		
 		if o[1]:
-			ren = dir.replace( '_client-zip', '' )
-			ren = ren.replace( '_server-zip', '' )
-			ren = ren.replace( '-zip', '' )
-			folder = True
+			name = os.path.basename( dir )
+			name = name.replace( '_client-zip', '' )
+			name = name.replace( '_server-zip', '' )
+			name = name.replace( '-zip', '' )
 		else:
-			ren = dir
-			folder = False
-		
-		if o[1]:
-			rename( dir, ren, options['verbose'] )
-		
-		verbose( 'Building archive %s from %s' % ( file, ren ), False )
+			name = None
 		
 		if os.path.exists( file ):
 			delete( path=file, verbose=options['verbose'] )
 		
-		zip( ren, file, folder )
+		# like zip, nothing is archived from a folder without files unless
+		# the folder itself goes in
+		if not name and not file_count( dir ):
+			verbose( 'Skipping archive %s, %s has no files' % ( file, dir ), False )
+			continue
+		
+		verbose( 'Building archive %s from %s' % ( file, dir ), False )
 		
-		if o[1]:
-			rename( ren, dir, options['verbose'] )
+		jobs.append( ( size( dir ), dir, file, name ) )
+	
+	# largest archives first so the slowest ones do not start last
+	jobs.sort()
+	jobs.reverse()
+	
+	cache = os.path.join( cache_build, 'archives' )
+	index = load_archives_cache( cache )
+	
+	if not os.path.exists( cache ):
+		os.makedirs( cache )
+	
+	jobs = [ ( t, d, f, n, cache, index, options['force'] ) for t, d, f, n in jobs ]
+	
+	failed = []
+	for file, error, elapsed, stamp, content, cached in processes( build_archive, jobs, options['jobs'], shared_pool ):
+		
+		if error:
+			failed.append( '%s (%s)' % ( file, error ) )
+			continue
+		
+		index[stamp] = content
+		archives_used.add( content )
+		pr_trace.count( 1, os.path.getsize( file ) )
+		
+		if cached:
+			verbose( 'Archive %s unchanged, reused from cache' % file, False )
+		else:
+			verbose( 'Archive %s built in %.2fs' % ( file, elapsed ), False )
+	
+	save_archives_cache( cache, index )
+	
+	if failed:
+		sys.exit( 'Failed to build archives:\n\t%s' % '\n\t'.join( failed ) )
+
+def build_archive( job ):
+	
+	total, source, destination, name, cache, index, force = job
+	
+	start = time.time()
+	
+	stamp = content = None
+	cached = False
+	
+	try:
+		
+		stamp = pr_zip.digest( source, name )
+		
+		if not force and stamp in index:
+			content = index[stamp]
+		else:
+			content = pr_zip.digest( source, name, True )
+		
+		blob = os.path.join( cache, '%s.zip' % content )
+		
+		if not force and os.path.exists( blob ):
+			link( blob, destination )
+			cached = True
+		
+		else:
+			zip( source, destination, name is not None, name )
+			
+			temp = '%s.%s' % ( blob, os.getpid() )
+			link( destination, temp )
+			try:
+				os.rename( temp, blob )
+			except OSError:
+				delete( temp )
+	
+	except ( IOError, OSError, zipfile.error ), e:
+		return destination, str( e ) or e.__class__.__name__, time.time() - start, stamp, content, cached
+	
+	return destination, None, time.time() - start, stamp, content, cached
+
+def evict_archives():
+	
+	# archives neither built nor reused by this run and no longer linked
+	# from any build tree go, the index forgets them with them
+	cache = os.path.join( cache_build, 'archives' )
+	
+	if not os.path.exists( cache ):
+		return
+	
+	removed = 0
+	freed = 0
+	
+	for name in os.listdir( cache ):
+		
+		blob = os.path.join( cache, name )
+		
+		if not name.endswith( '.zip' ) or name[0:-4] in archives_used:
+			continue
+		
+		if file_info( blob )[1] > 1:
+			continue
+		
+		freed += os.path.getsize( blob )
+		delete( path=blob )
+		removed += 1
+	
+	save_archives_cache( cache, load_archives_cache( cache ) )
+	
+	verbose( 'Archive cache: %s unused archives removed, %.1f MB freed' % ( removed, freed / 1048576.0 ), False )
+
+def load_archives_cache( path ):
+	
+	index = {}
+	
+	if not os.path.exists( os.path.join( path, 'index.txt' ) ):
+		return index
+	
+	for line in open( os.path.join( path, 'index.txt' ) ):
+		line = line.split()
+		if len( line ) == 2:
+			index[line[0]] = line[1]
+	
+	return index
+
+def save_archives_cache( path, index ):
+	
+	if not os.path.exists( path ):
+		os.makedirs( path )
+	
+	f = open( os.path.join( path, 'index.txt' ), 'w' )
+	for stamp, content in index.iteritems():
+		if os.path.exists( os.path.join( path, '%s.zip' % content ) ):
+			f.write( '%s %s\n' % ( stamp, content ) )
+	f.close()
 
 def compile_python( path ):
 	
 	verbose( 'Compiling python', False )
-	compileall.compile_dir( path, 1, quiet=options['quiet'] )
+	
+	# the same modules as compileall.compile_dir( path, 1 ), the game
+	# folder and one level of subfolders
+	sources = []
+	
+	for root, dirs, files in os.walk( path ):
+		
+		if root != path:
+			dirs[:] = []
+		elif '.svn' in dirs:
+			dirs.remove( '.svn' )
+		
+		for name in files:
+			if name.endswith( '.py' ):
+				sources.append( os.path.join( root, name ) )
+	
+	cache = os.path.join( cache_build, 'python' )
+	
+	if not os.path.exists( cache ):
+		makedirs( cache )
+	
+	jobs = [ ( source, cache, options['force'] ) for source in sources ]
+	
+	failed = []
+	used = set()
+	reused = 0
+	for source, error, content, cached in processes( compile_module, jobs, options['jobs'], shared_pool ):
+		
+		if error:
+			failed.append( '%s (%s)' % ( source, error ) )
+			continue
+		
+		used.add( content )
+		if cached:
+			reused += 1
+	
+	if failed:
+		sys.exit( 'Failed to compile python:\n\t%s' % '\n\t'.join( failed ) )
+	
+	# every module is compiled every build, bytecode of sources that changed
+	# or went away is never asked for again
+	removed = 0
+	for name in os.listdir( cache ):
+		if name.endswith( '.pyc' ) and name[0:-4] not in used:
+			delete( path=os.path.join( cache, name ) )
+			removed += 1
+	
+	verbose( 'Compiled %s modules, %s unchanged reused from cache, %s old ones removed' % ( len( sources ), reused, removed ), False )
+
+def compile_module( job ):
+	
+	source, cache, force = job
+	
+	destination = source + ( __debug__ and 'c' or 'o' )
+	
+	try:
+		
+		# the code object keeps the path it was compiled from
+		data = open( source, 'rb' ).read()
+		content = hashlib.sha1( '%s %s\n%s' % ( imp.get_magic(), source, data ) ).hexdigest()
+		
+		blob = os.path.join( cache, '%s.pyc' % content )
+		
+		if not force and os.path.exists( blob ):
+			
+			# same bytecode, only the source timestamp in the header differs
+			code = open( blob, 'rb' ).read()
+			mtime = int( os.stat( source ).st_mtime ) & 0xFFFFFFFF
+			
+			delete( path=destination )
+			f = open( destination, 'wb' )
+			f.write( code[0:4] + struct.pack( '<I', mtime ) + code[8:] )
+			f.close()
+			
+			return source, None, content, True
+		
+		py_compile.compile( source, destination, None, True )
+		
+		temp = '%s.%s' % ( blob, os.getpid() )
+		link( destination, temp )
+		try:
+			os.rename( temp, blob )
+		except OSError:
+			delete( temp )
+	
+	except py_compile.PyCompileError, e:
+		return source, e.msg.strip().splitlines()[-1], None, False
+	
+	except ( IOError, OSError ), e:
+		return source, str( e ) or e.__class__.__name__, None, False
+	
+	return source, None, content, False
 
 def clean_levels( path ):
 
 	verbose( 'Cleaning levels %s' % path, False )
 	
-	if not options['test']:
-		for level in test_levels:
-			delete( path=path, pattern=level, recursive=True, verbose=options['verbose'] )
+	if options['test']:
+		return []
+	
+	return prune( path, test_levels, True, [], False, options['verbose'] )
 
 def clean_python( path ):
 	
 	verbose( 'Cleaning python %s' % path, False )
 	
-	delete( path=path, pattern='assets',   recursive=True, verbose=options['verbose'] )
-	delete( path=path, pattern='compiled', recursive=True, verbose=options['verbose'] )
-	delete( path=path, pattern='debug',    recursive=True, verbose=options['verbose'] )
+	removed = prune( path, [ 'assets', 'compiled', 'debug' ], True, [], False, options['verbose'] )
 	
 	game = os.path.join( path, 'game' )
-	delete( game, '*.py', True, [ '__init__.py', 'gpm_*.py', 'realityconfig_common.py', 'realityconfig_local.py', 'realityconfig_private.py', 'realityconfig_coop.py' ], options['verbose'] )
-	delete( game, 'gpm_*.pyc', True, [], options['verbose'] )
-	delete( game, 'realityconfig_*.pyc', True, [ 'realityconfig_public.pyc' ], options['verbose'] )
-	delete( game, '__init__.pyc', True, [], options['verbose'] )
+	removed.extend( prune( game, 
+		[ '*.py', 'gpm_*.pyc', 'realityconfig_*.pyc', '__init__.pyc' ], True, 
+		[ '__init__.py', 'gpm_*.py', 'realityconfig_common.py', 'realityconfig_local.py', 'realityconfig_private.py', 'realityconfig_coop.py', 'realityconfig_public.pyc' ], 
+		False, options['verbose'] ) )
+	
+	return removed
 
 def clean_atlas( path ):
 
@@ -1077,19 +1735,24 @@ def update_archives( patch ):
 		build_filecon = os.path.join( core_build, filecon )
 		patch_filecon = os.path.join( path_core_build( patch ), filecon )
 		
-		copy( repo_filecon, patch_filecon, options['verbose'] )
+		archive_content = archives_source.get( patch, {} ).get( filecon )
+		
+		if archive_content is None:
+			if not os.path.exists( repo_filecon ):
+				continue
+			archive_content = open( repo_filecon ).read()
+		
+		verbose( 'Writing %s' % patch_filecon, False )
+		delete( path=patch_filecon )
+		g = open( patch_filecon, 'w' )
+		g.write( archive_content )
+		g.close()
 		
 		if not patch:
 			continue
 		
-		archive_content = ''
 		patch_replacer  = 'rem patch'
 		
-		f = open( repo_filecon, 'r' )
-		for line in f:
-			archive_content += line
-		f.close()
-		
 		for i in range( 1, patch+1 ):
 			if archive_content.find( '_patch%s' % i ) != -1:
 				continue
@@ -1100,9 +1763,8 @@ def update_archives( patch ):
 				if not o[0]:
 					continue
 				
-				ps = os.path.join( path_core_build( i ), os.path.normcase( p ) )
-				
-				if os.path.exists( '%s_patch%s.zip' % ( ps, i ) ):
+				# zips without entries were never built by zip, nothing to mount
+				if manifest( i )['zips'].get( '%s_patch%s.zip' % ( p, i ) ):
 					verbose( 'Updating %s to mount %s_patch%s.zip' % ( filecon, p, i ), False )
 					patch_content += 'fileManager.mountArchive %s_patch%s.zip %s\n' % ( p, i, o[0] )
 			
@@ -1117,6 +1779,140 @@ def update_archives( patch ):
 	
 		copy( patch_filecon, build_filecon, options['verbose'] )
 
+def manifest( patch, save=False ):
+	
+	# { 'zips': { archive: [ ( entry, crc, size ) ] }, 'folders': set of archive
+	# folders not archived yet } of a core build, keys relative with / like
+	# core_archives. Read once from its manifest file or, for builds made
+	# without one, from the build itself. Only the archive stage saves a
+	# scan, other stages may look while a merge is still changing the build.
+	manifests_lock.acquire()
+	try:
+		
+		if patch in manifests:
+			return manifests[patch]
+		
+		path = manifest_path( patch )
+		
+		if os.path.exists( path ):
+			m = read_manifest( path )
+		else:
+			m = scan_manifest( patch )
+			if save:
+				write_manifest( path, m )
+		
+		manifests[patch] = m
+		
+		return m
+	
+	finally:
+		manifests_lock.release()
+
+def forget_manifest( patch ):
+	
+	manifests_lock.acquire()
+	try:
+		manifests.pop( patch, None )
+		delete( path=manifest_path( patch ) )
+	finally:
+		manifests_lock.release()
+
+def manifest_path( patch ):
+	return os.path.join( builds_path, 'manifests', 'core%s.txt' % patch_sufix( patch ) )
+
+def scan_manifest( patch ):
+	
+	cb = path_core_build( patch )
+	m = { 'zips': {}, 'folders': set() }
+	
+	# one listing per folder holding archives
+	listed = {}
+	
+	for type in ['server','client']:
+		for p,o in core_archives[options['zip']][type].iteritems():
+			
+			folder, name = ( '/' + p ).rsplit( '/', 1 )
+			folder = folder.strip( '/' )
+			
+			if folder not in listed:
+				d = os.path.join( cb, os.path.normcase( folder ) )
+				if os.path.isdir( d ):
+					listed[folder] = set( [ os.path.normcase( n ) for n in os.listdir( d ) ] )
+				else:
+					listed[folder] = set()
+			
+			if os.path.normcase( '%s-zip' % name ) in listed[folder]:
+				m['folders'].add( p )
+			
+			for z in set( [ '%s.zip' % p, '%s%s.zip' % ( p, patch_sufix( patch ) ) ] ):
+				
+				if os.path.normcase( z.split( '/' )[-1] ) not in listed[folder]:
+					continue
+				
+				try:
+					m['zips'][z] = pr_zip.listing( os.path.join( cb, os.path.normcase( z ) ) )
+				except ( IOError, zipfile.error ):
+					m['zips'][z] = []
+	
+	return m
+
+def read_manifest( path ):
+	
+	m = { 'zips': {}, 'folders': set() }
+	
+	entries = None
+	for line in open( path ):
+		
+		line = line.rstrip( '\n' )
+		
+		if line.startswith( '\t' ):
+			crc, size, name = line[1:].split( ' ', 2 )
+			entries.append( ( name, int( crc, 16 ), int( size ) ) )
+		elif line.startswith( 'zip ' ):
+			entries = m['zips'][line[4:]] = []
+		elif line.startswith( 'folder ' ):
+			m['folders'].add( line[7:] )
+	
+	return m
+
+def write_manifest( path, m ):
+	
+	if not os.path.exists( os.path.dirname( path ) ):
+		makedirs( os.path.dirname( path ) )
+	
+	f = open( path, 'w' )
+	
+	for z in sorted( m['zips'].keys() ):
+		f.write( 'zip %s\n' % z )
+		for name, crc, size in m['zips'][z]:
+			f.write( '\t%08x %s %s\n' % ( crc, size, name ) )
+	
+	for p in sorted( m['folders'] ):
+		f.write( 'folder %s\n' % p )
+	
+	f.close()
+
+def write_trace():
+	
+	pr_trace.write( os.path.join( logs_path, 'trace.json' ) )
+	
+	lines = pr_trace.summary()
+	write_log( 'summary.txt', lines )
+	
+	verbose( 'SUMMARY' )
+	for line in lines:
+		verbose( line, False )
+
+def write_log( name, lines ):
+	
+	if not os.path.exists( logs_path ):
+		makedirs( logs_path )
+	
+	f = open( os.path.join( logs_path, name ), 'w' )
+	for line in lines:
+		f.write( line + '\n' )
+	f.close()
+
 def verbose( text, prefix=True ):
 	if options['verbose']:
 		if prefix:
@@ -1127,37 +1923,20 @@ def verbose( text, prefix=True ):
 def chunked(s, n): 
 	return [s[i:i+n:n] for i in xrange(0, len(s), n)]
 
-def zip( source, destination, folder=False, filters='' ):
+def zip( source, destination, folder=False, name=None ):
 	
 	if not os.path.exists( source ):
 		return
 	
 	verbose( 'Archiving %s to %s' % ( source, destination ), False )
 	
-	root = os.getcwd()
-	
-	if folder:
-		os.chdir( os.path.join( source, '..' + os.sep ) )
-		d = os.path.basename( destination )
-		s = os.path.basename( source )
-	else:
-		os.chdir( os.path.join( source ) )
-		d = os.path.join( '..', os.path.basename( destination ) )
-		s = '*'
-	
-	if os.name not in ['posix','mac']:
-		
-		if options['quiet']:
-			q = '> nul'
-		else:
-			q = ''
-		
-		os.system( '"%s" a -tzip %s %s %s -xr!.svn\\ -xr!Assets\\ -xr!assets\\ %s' % ( exec_7zip, d, s, filters, q ) )
+	if folder and not name:
+		name = os.path.basename( source )
 	
-	else:
-		os.system( 'zip -r %s %s %s -x \*/assets/\* -x \*/.*' % ( options['quiet'], d, s ) ) 
+	if not folder:
+		name = None
 	
-	os.chdir( root )
+	return pr_zip.write( source, destination, name )
 
 def wait():
 	if options['wait']:
@@ -89,6 +89,7 @@ if __name__ == "__main__":
 	pr_build.copy( os.path.join( pr_build.root_path, 'test', pr_build.options['zip'] ), os.path.abspath( repo_path ) )
 	
 	pr_build.builds_path = os.path.join( pr_build.root_path, 'test_builds' )
+	pr_build.logs_path   = os.path.join( pr_build.builds_path, 'logs' )
 	
 	if '-k' not in sys.argv and '--skip' not in sys.argv:
 		pr_build.delete( pr_build.builds_path )
@@ -107,6 +108,8 @@ if __name__ == "__main__":
 
 	pr_build.core_build_patch   = os.path.join( pr_build.builds_path, 'core_patch' )
 	pr_build.levels_build_patch = os.path.join( pr_build.builds_path, 'levels_patch' )
+	
+	pr_build.cache_build        = os.path.join( pr_build.builds_path, 'cache' )
 
 	pr_build.core_installer_path   = os.path.join( pr_build.installer_path, 'pr_core_base.iss' )
 	pr_build.levels_installer_path = os.path.join( pr_build.installer_path, 'pr_levels_base.iss' )
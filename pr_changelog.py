@@ -10,6 +10,11 @@ import tempfile
 import re
 from xml.sax import saxutils
 
+try:
+	import json
+except ImportError:
+	json = None
+
 import pr_svn
 
 help_message = '''
@@ -48,6 +53,14 @@ Other options:
 	-x --xxx         hide all comments with xxxx
 	-f --fun         hide all comments except first and last letter of each word
 	-p --paths       show modified paths (includes empty log messages)
+	-c --cache       log cache file (default ~/.pr_svnlog.db, none to disable)
+	-s --subtree     only changes below this path, e.g. levels/fallujah or
+	                 objects/vehicles_server-zip (also looked for below trunk and levels)
+	
+	-i --incremental keep an rss feed of one item per revision in FILE, its state
+	                 goes to FILE.state and later runs only fetch newer revisions
+	                 (the revision range is only used for the first run)
+	-k --keep        number of revisions in the incremental feed (default 50)
 	
 	-v --verbose     run it verbosely
 	-q --quiet       run it quietly
@@ -65,6 +78,10 @@ options = {
 	'multi': None,
 	'hide': None,
 	'paths': None,
+	'cache': os.path.join( os.path.expanduser( '~' ), '.pr_svnlog.db' ),
+	'subtree': None,
+	'incremental': None,
+	'keep': 50,
 	
 	'verbose': '',
 	'quiet': ''
@@ -87,13 +104,13 @@ def main(argv=None):
 	try:
 		try:
 			opts, args = getopt.getopt(argv[1:], 
-				"hr:tywg:o:n:d:mxfpvq", 
+				"hr:tywg:o:n:d:mxfpc:s:i:k:vq", 
 				[ "help", "revision=", "today", "yesterday", "week", "group=",
-					"output=", "name=", "default=", "multi", "xxx", "fun", "paths", "verbose", "quiet" ])
+					"output=", "name=", "default=", "multi", "xxx", "fun", "paths", "cache=", "subtree=", "incremental=", "keep=", "verbose", "quiet" ])
 		except getopt.error, msg:
 			raise Usage(msg)
 		
-		options['revision'] = '{"' + lastweek.isoformat() + 'T00:00Z"}:HEAD'
+		options['revision'] = '{' + lastweek.isoformat() + 'T00:00Z}:HEAD'
 		
 		for option, value in opts:
 			
@@ -103,11 +120,11 @@ def main(argv=None):
 			if option in ("-r", "--revision"):
 				options['revision'] = value
 			if option in ("-t", "--today"):
-				options['revision'] = '{"' + today.isoformat() + 'T00:00Z"}:{"' + today.isoformat() + 'T23:59Z"}'
+				options['revision'] = '{' + today.isoformat() + 'T00:00Z}:{' + today.isoformat() + 'T23:59Z}'
 			if option in ("-y", "--yesterday"):
-				options['revision'] = '{"' + yesterday.isoformat() + 'T00:00Z"}:{"' + yesterday.isoformat() + 'T23:59Z"}'
+				options['revision'] = '{' + yesterday.isoformat() + 'T00:00Z}:{' + yesterday.isoformat() + 'T23:59Z}'
 			if option in ("-w", "--week"):
-				options['revision'] = '{"' + lastweek.isoformat() + 'T00:00Z"}:{"' + yesterday.isoformat() + 'T23:59Z"}'
+				options['revision'] = '{' + lastweek.isoformat() + 'T00:00Z}:{' + yesterday.isoformat() + 'T23:59Z}'
 			
 			if option in ("-g", "--group") and value in ['date','category','author','none']:
 				options['group'] = value
@@ -128,6 +145,17 @@ def main(argv=None):
 				options['hide'] = False
 			if option in ("-p", "--paths"):
 				options['paths'] = True
+			if option in ("-c", "--cache"):
+				options['cache'] = value
+			if option in ("-s", "--subtree"):
+				options['subtree'] = value
+			if option in ("-i", "--incremental"):
+				options['incremental'] = value
+			if option in ("-k", "--keep"):
+				try:
+					options['keep'] = int( value )
+				except ValueError:
+					raise Usage('Number of items to keep must be a number')
 			
 			if option in ("-v", "--verbose"):
 				options['verbose'] = '-v'
@@ -142,7 +170,28 @@ def main(argv=None):
 		if options['output'] not in ['text', 'bbcode', 'rss', 'test']:
 			raise Usage( 'Incorrect output format (text, bbcode, rss, test)' )
 			
-		logs = pr_svn.log( options['path'], options['revision'], options['paths'], options['multi'], options['default'] )
+		if options['cache'] != 'none':
+			pr_svn.log_cache = options['cache']
+		
+		if options['incremental']:
+			
+			if not json:
+				raise Usage('Incremental feeds need the json module')
+			
+			incremental( options['path'], options['incremental'], options['keep'] )
+			return 0
+		
+		revision = options['revision']
+		
+		# svn is asked for the entries in the order they are written in and
+		# they are written as they arrive, only the other groupings hold
+		# every entry
+		if options['group'] == 'none':
+			revision = pr_svn.reverse_range( revision )
+		elif options['group'] == 'date':
+			revision = pr_svn.newest_first( options['path'], revision )
+		
+		logs = pr_svn.log( options['path'], revision, options['paths'], options['multi'], options['default'], options['subtree'] )
 		
 		if options['hide'] in [ True, False ]:
 			logs = hide( logs, options['hide'] )
@@ -164,50 +213,58 @@ def main(argv=None):
 		print >> sys.stderr, sys.argv[0].split("/")[-1] + ": " + str(err.msg)
 		# print >> sys.stderr, "\t for help use --help"
 		return 2
+	
+	except pr_svn.SvnError, err:
+		print >> sys.stderr, sys.argv[0].split("/")[-1] + ": " + str(err.msg)
+		return 1
 
 
-def header( path, revision, output='text' ):
+def header( path, revision, output='text', write=None ):
+	
+	write = write or sys.stdout.write
 	
 	if output == 'rss':
-		print '<?xml version="1.0"?>'
-		print '<rss version="2.0">'
-		print '<channel>'
-		print '<title>Project Reality Mod Changelog%s</title>' % saxutils.escape(options['name'])
-		print '<link>http://realitymod.com</link>'
-		print '<description>Latest changelog information.</description>'
-		print '<language>en-us</language>'
-		print '<pubDate>%s</pubDate>' % today_rfc
-		print '<lastBuildDate>%s</lastBuildDate>' % today_rfc
+		write( '<?xml version="1.0"?>\n' )
+		write( '<rss version="2.0">\n' )
+		write( '<channel>\n' )
+		write( '<title>Project Reality Mod Changelog%s</title>\n' % saxutils.escape(options['name']) )
+		write( '<link>http://realitymod.com</link>\n' )
+		write( '<description>Latest changelog information.</description>\n' )
+		write( '<language>en-us</language>\n' )
+		write( '<pubDate>%s</pubDate>\n' % today_rfc )
+		write( '<lastBuildDate>%s</lastBuildDate>\n' % today_rfc )
 	
 	if output == 'test':
-		print '[QUOTE][B]How To Use This Test List:[/B]'
-		print '[LIST]'
-		print '[*] Please color code the results of the test according to the legend below'
-		print '[*] Each item should be worked on individually, then once completed, moved to the appropriate section (GOOD TO GO or PROBLEMS).'
-		print '[*] If a test item has any problems at all, it should stay in problems.'
-		print '[*] If a test item still needs further testing it should stay in need to test.'
-		print '[/LIST]\n'
-		print '[B]Test Results Text Legend:[/B]'
-		print '[COLOR=Green]Working Good[/COLOR]'
-		print '[COLOR=Red]Problem[/COLOR]'
-		print '[COLOR="RoyalBlue"]Fixed for next build[/COLOR][/QUOTE]\n'
-		print '[SIZE=9]NEED TO TEST:[/SIZE]\n'
+		write( '[QUOTE][B]How To Use This Test List:[/B]\n' )
+		write( '[LIST]\n' )
+		write( '[*] Please color code the results of the test according to the legend below\n' )
+		write( '[*] Each item should be worked on individually, then once completed, moved to the appropriate section (GOOD TO GO or PROBLEMS).\n' )
+		write( '[*] If a test item has any problems at all, it should stay in problems.\n' )
+		write( '[*] If a test item still needs further testing it should stay in need to test.\n' )
+		write( '[/LIST]\n\n' )
+		write( '[B]Test Results Text Legend:[/B]\n' )
+		write( '[COLOR=Green]Working Good[/COLOR]\n' )
+		write( '[COLOR=Red]Problem[/COLOR]\n' )
+		write( '[COLOR="RoyalBlue"]Fixed for next build[/COLOR][/QUOTE]\n\n' )
+		write( '[SIZE=9]NEED TO TEST:[/SIZE]\n\n' )
 	
 	if output == 'bbcode':
-		print '[SIZE="6"]%s[/SIZE]\n' % revision
+		write( '[SIZE="6"]%s[/SIZE]\n\n' % revision )
 	
 	if output == 'text':
-		print '============================================================='
-		print str( revision )
-		print '=============================================================\n'
+		write( '=============================================================\n' )
+		write( str( revision ) + '\n' )
+		write( '=============================================================\n\n' )
 
-def footer( path, revision, output='text' ):
+def footer( path, revision, output='text', write=None ):
+	
+	write = write or sys.stdout.write
 	
 	if output == 'rss':
-		print '</channel>'
-		print '</rss>'
+		write( '</channel>\n' )
+		write( '</rss>\n' )
 	if output in ['text','bbcode']:
-		print '\n%s UTC\n' % datetime.datetime.utcnow()
+		write( '\n%s UTC\n\n' % datetime.datetime.utcnow() )
 
 def compare(a,b):
 	return cmp( a, b )
@@ -220,144 +277,250 @@ def hide( logs, hide=None ):
 	else:
 		p = re.compile('\B.\B', re.MULTILINE)
 	
-	for key,entry in enumerate( logs ):
+	for entry in logs:
 		entry['message'] = pn.sub( 'x', entry['message'] )
 		entry['message'] = p.sub(  'x', entry['message'] )
-		logs[key] = entry
+		yield entry
+
+# per output format: section start and end, an entry with and without a
+# message, a modified path and what a new line becomes. Rss sections are
+# CDATA, so only their title, name and path fields are escaped.
+templates = {
+	'text': {
+		'begin': '\n-------------------------------------------------------------\n%(title)s\n-------------------------------------------------------------\n\n',
+		'end': '',
+		'entry': '%(category)s: %(message)s (%(author)s) %(revision)s\n',
+		'empty': '---- (%(author)s) %(revision)s\n',
+		'path': '     %s %s\n',
+		'newline': None
+	},
+	'bbcode': {
+		'begin': '\n[SIZE="4"]%(title)s[/SIZE]\n\n',
+		'end': '',
+		'entry': '%(category)s: %(message)s (%(author)s) %(revision)s\n',
+		'empty': '---- (%(author)s) %(revision)s\n',
+		'path': '     %s %s\n',
+		'newline': None
+	},
+	'test': {
+		'begin': '\n[SIZE="4"]%(title)s[/SIZE]\n\n',
+		'end': '',
+		'entry': '[QUOTE]Test: %(message)s (%(author)s) %(revision)s[/QUOTE]\n\n',
+		'empty': '',
+		'path': None,
+		'newline': None
+	},
+	'rss': {
+		'begin': '<item>\n<title>Changelog - %(title)s%(name)s</title>\n<description><![CDATA[',
+		'end': ']]></description>\n<pubDate>%(title)s 23:59:59 GMT</pubDate>\n<guid isPermalink="false">%(path)s - %(title)s</guid>\n</item>\n',
+		'entry': '%(category)s: %(message)s (%(author)s) %(revision)s\n',
+		'empty': '---- (%(author)s) %(revision)s\n',
+		'path': '&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;%s %s\n',
+		'item': '<item>\n<title>%s</title>\n<description><![CDATA[%s]]></description>\n<pubDate>%s GMT</pubDate>\n<guid isPermalink="false">%s</guid>\n</item>\n',
+		'newline': '<br />\n'
+	}
+}
+
+def by_none( logs, output='text', write=None ):
+	
+	# logs come newest first, the lines of a revision are written last
+	# to first as well, rss gets one item per revision
+	write = write or sys.stdout.write
 	
-	return logs
+	for entries in revisions( logs ):
+		
+		if output == 'rss':
+			write( rss_item( entries ) )
+			continue
+		
+		for entry in reversed( entries ):
+			write( message( entry, output ) )
+	
+	write( '\n' )
 
-def by_none( logs, output='text' ):
+def revisions( logs ):
 	
-	logs.reverse()
+	# consecutive entries of the same revision, one list per revision
+	entries = []
 	
-	entries = ''
 	for entry in logs:
 		
-		if output == 'rss':
-			txt  = '<item>\n'
-			txt += '<title>%s</title>\n' % ( saxutils.escape(message( entry, output ).replace( '<br />\n', '' )) )
-			txt += '<description></description>\n'
-			txt += '<pubDate>%s GMT</pubDate>\n' % ( entry['datetime'].strftime('%a, %d %b %Y %H:%M:%S') )
-			txt += '<guid isPermalink="false">%s</guid>\n' % ( entry['revision'] )
-			txt += '</item>\n'
-		else:
-			txt = message( entry, output )
-			
-		entries += txt
+		if entries and entries[0]['revision'] != entry['revision']:
+			yield entries
+			entries = []
+		
+		entries.append( entry )
 	
-	print entries
+	if entries:
+		yield entries
 
-def by_category( logs, output='text' ):
+def rss_item( entries ):
 	
-	logs_grouped = grouped( logs, 'category' )
-	groups = logs_grouped.keys()
-	groups.sort(compare)
+	# one item per revision, the revision is its guid, titled by the first
+	# line with every line in the description
+	entry = entries[0]
+	
+	title = saxutils.escape( message( entry, 'rss' ).replace( '<br />\n', '' ) )
+	description = ''.join( [ message( e, 'rss' ) for e in entries ] )
+	
+	return templates['rss']['item'] % ( title, description, entry['datetime'].strftime('%a, %d %b %Y %H:%M:%S'), entry['revision'] )
+
+def incremental( path, feed, keep ):
+	
+	# the state keeps the last revision seen and the rendered items, so a
+	# refresh only asks svn about newer revisions and renders only those
+	state = load_state( feed + '.state' )
+	
+	if state:
+		
+		head = pr_svn.revision_number( path, 'HEAD' )
+		
+		if head <= state['revision'] and os.path.exists( feed ):
+			return
+		
+		revision = '%s:%s' % ( state['revision'] + 1, head )
+		items = state['items']
+	
+	else:
+		head = None
+		revision = options['revision']
+		items = []
 	
-	if len( groups ) == 0:
+	logs = []
+	if not state or head > state['revision']:
+		logs = list( pr_svn.log( path, revision, options['paths'], options['multi'], options['default'], options['subtree'] ) )
+	
+	if options['hide'] in [ True, False ]:
+		logs = list( hide( logs, options['hide'] ) )
+	
+	if state:
+		last = head
+	elif logs:
+		last = max( [ int( entry['revision'] ) for entry in logs ] )
+	else:
+		last = pr_svn.revision_number( path, 'HEAD' )
+	
+	# newer revisions outside the path still move the state forward
+	if not logs and os.path.exists( feed ):
+		save_state( feed + '.state', last, items )
 		return
 	
-	for g in groups:
+	new = [ rss_item( entries ) for entries in revisions( logs ) ]
+	new.reverse()
 	
-		msg = category( g.upper(), output )
+	items = ( new + items )[0:keep]
 	
-		entries = ''
-		for entry in logs_grouped[g]:
-			entries += message( entry, output )
+	# written next to the feed and renamed, readers never see half a feed
+	temp = '%s.%s' % ( feed, os.getpid() )
+	f = open( temp, 'wb' )
+	try:
+		header( path, revision, 'rss', f.write )
+		for item in items:
+			f.write( item )
+		f.write( '\n' )
+		footer( path, revision, 'rss', f.write )
+		f.close()
+	except:
+		f.close()
+		os.remove( temp )
+		raise
+	
+	if os.path.exists( feed ):
+		os.remove( feed )
+	os.rename( temp, feed )
+	
+	save_state( feed + '.state', last, items )
+
+def load_state( path ):
+	
+	if not os.path.exists( path ):
+		return None
 	
-		print msg % entries
+	try:
+		state = json.load( open( path ) )
+		# json gives unicode back, the items are written as the utf-8 svn gave
+		return { 'revision': int( state['revision'] ), 'items': [ item.encode( 'utf-8' ) for item in state['items'] ] }
+	except ( ValueError, KeyError, TypeError, AttributeError ):
+		return None
 
-def by_date( logs, output='text' ):
+def save_state( path, revision, items ):
 	
-	logs_grouped = grouped( logs, 'date' )
+	f = open( path, 'w' )
+	json.dump( { 'revision': revision, 'items': items }, f )
+	f.close()
+
+def by_category( logs, output='text', write=None ):
+	
+	logs_grouped = grouped( logs, 'category' )
 	groups = logs_grouped.keys()
 	groups.sort(compare)
-	groups.reverse()
 	
-	if len( groups ) == 0:
-		return
+	for g in groups:
+		section( g.upper(), logs_grouped[g], output, write )
+
+def by_date( logs, output='text', write=None ):
 	
-	groups.pop()
+	# logs come newest first, a day is written once the next one starts so
+	# only one day is held at a time, the oldest day is never written
+	day = None
+	entries = []
 	
-	for g in groups:
-		
-		date = datetime.date( int( g[0:4] ), int( g[5:7] ), int( g[8:10] ) )
-		msg = category( date.strftime('%a, %d %b %Y'), output )
+	for entry in logs:
 		
-		entries = ''
-		for entry in logs_grouped[g]:
-			entries += message( entry, output )
+		if entries and entry['date'] != day:
+			
+			# oldest revision of the day first
+			entries.sort( key=lambda e: int( e['revision'] ) )
+			
+			date = datetime.date( int( day[0:4] ), int( day[5:7] ), int( day[8:10] ) )
+			section( date.strftime('%a, %d %b %Y'), entries, output, write )
+			entries = []
 		
-		print msg % entries
+		day = entry['date']
+		entries.append( entry )
 
-def by_author( logs, output='text' ):
+def by_author( logs, output='text', write=None ):
 	
 	logs_grouped = grouped( logs, 'author' )
 	groups = logs_grouped.keys()
 	groups.sort(compare)
 	
-	if len( groups ) == 0:
-		return
-	
 	for g in groups:
-		
-		msg = category( g.upper(), output )
-		
-		entries = ''
-		for entry in logs_grouped[g]:
-			entries += message( entry, output )
-		
-		print msg % entries
+		section( g.upper(), logs_grouped[g], output, write )
 
-def message( entry, output='text' ):
+def section( title, entries, output='text', write=None ):
 	
-	if output == 'test' and entry['message']:
-		txt = '[QUOTE]Test: %s (%s) %s[/QUOTE]\n\n' % ( entry['message'], entry['author'], entry['revision'] )
+	# entries are written one by one between the section start and end
+	write = write or sys.stdout.write
 	
-	if output in ['text','bbcode','rss']:
-		if entry['message']:
-			txt = '%s: %s (%s) %s\n' % ( entry['category'], entry['message'], entry['author'], entry['revision'] )
-		else:
-			txt = '---- (%s) %s\n' % ( entry['author'], entry['revision'] )
-		
-		if options['paths']:
-			
-			for path in entry['paths']:
-				a,p = path
-				if output == 'rss':
-					prefix = '&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;'
-				else:
-					prefix = '     '
-				txt += '%s%s %s\n' % ( prefix, a, p )
-			txt += '\n'
+	t = templates[output]
+	fields = { 'title': title, 'name': options['name'], 'path': options['path'] }
 	
 	if output == 'rss':
-		txt = txt.replace( '\n', '<br />\n' )
+		for key, value in fields.items():
+			fields[key] = saxutils.escape( value )
 	
-	return txt
+	write( t['begin'] % fields )
+	
+	for entry in entries:
+		write( message( entry, output ) )
+	
+	write( t['end'] % fields + '\n' )
 
-def category( msg, output='text' ):
+def message( entry, output='text' ):
 	
-	if output == 'text':
+	t = templates[output]
 	
-		txt  = '\n-------------------------------------------------------------\n'
-		txt += msg
-		txt += '\n-------------------------------------------------------------\n\n'
-		txt += '%s'
+	if entry['message']:
+		txt = t['entry'] % entry
+	else:
+		txt = t['empty'] % entry
 	
-	if output in ['bbcode','test']:
-		
-		txt  = '\n[SIZE="4"]%s[/SIZE]\n\n' % msg
-		txt += '%s'
+	if options['paths'] and t['path']:
+		txt += ''.join( [ t['path'] % path for path in entry['paths'] ] ) + '\n'
 	
-	if output == 'rss':
-		
-		txt  = '<item>\n'
-		txt += '<title>Changelog - %s%s</title>\n' % ( saxutils.escape(msg), saxutils.escape(options['name']) )
-		txt += '<description><![CDATA[%s]]></description>\n'
-		txt += '<pubDate>%s %s</pubDate>\n' % ( saxutils.escape(msg), '23:59:59 GMT' )
-		txt += '<guid isPermalink="false">%s - %s</guid>\n' % ( saxutils.escape(options['path']), saxutils.escape(msg) )
-		txt += '</item>\n'
+	if t['newline']:
+		txt = txt.replace( '\n', t['newline'] )
 	
 	return txt
 
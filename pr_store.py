@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import os.path
+import errno
+import hashlib
+
+from pr_utils import pool, makedirs, delete, writable, hardlink, file_info, copy_buffer
+
+# content addressed store: every stored file is a hard link to
+# objects/<first two hex digits>/<sha1 of its content>, so build trees
+# holding the same file share one copy on disk. Needs os.link and real
+# inode numbers, python 2 on windows has neither.
+
+def load( store ):
+	
+	# file identity -> hash of every object, files that already are links
+	# into the store never need hashing again
+	known = {}
+	
+	objects = os.path.join( store, 'objects' )
+	
+	for root, dirs, files in os.walk( objects ):
+		for name in files:
+			known[file_info( os.path.join( root, name ) )[0]] = name
+	
+	return known
+
+def put( store, path, known ):
+	
+	# links every file of the tree into the store, returns the hashes the
+	# tree uses, the number of files and the bytes shared with other files
+	jobs = []
+	
+	for root, dirs, files in os.walk( path ):
+		for name in files:
+			jobs.append( ( store, os.path.join( root, name ), known ) )
+	
+	hashes = set()
+	shared = 0
+	
+	for h, s in pool( put_file, jobs ):
+		hashes.add( h )
+		shared += s
+	
+	return hashes, len( jobs ), shared
+
+def put_file( job ):
+	
+	store, path, known = job
+	
+	identity = file_info( path )[0]
+	
+	if identity in known:
+		return known[identity], 0
+	
+	h = digest( path )
+	o = blob( store, h )
+	
+	makedirs( os.path.dirname( o ) )
+	
+	try:
+		hardlink( path, o )
+		known[identity] = h
+		return h, 0
+	except OSError, e:
+		# another file with the same content got there first
+		if e.errno != errno.EEXIST:
+			return h, 0
+	
+	# linked next to the file first, a failed link (too many links to the
+	# object, or a file system without them) leaves the file as it was
+	temp = '%s.store' % path
+	
+	try:
+		hardlink( o, temp )
+	except OSError:
+		return h, 0
+	
+	size = os.path.getsize( path )
+	
+	writable( path )
+	os.remove( path )
+	os.rename( temp, path )
+	
+	return h, size
+
+def gc( store, hashes ):
+	
+	# removes the objects no tree in hashes uses, data still linked from
+	# trees outside the chain stays with them, only the store forgets it
+	removed = 0
+	freed = 0
+	
+	objects = os.path.join( store, 'objects' )
+	
+	for root, dirs, files in os.walk( objects ):
+		for name in files:
+			
+			if name in hashes:
+				continue
+			
+			o = os.path.join( root, name )
+			
+			if file_info( o )[1] == 1:
+				freed += os.path.getsize( o )
+			
+			delete( o )
+			removed += 1
+	
+	return removed, freed
+
+def blob( store, h ):
+	return os.path.join( store, 'objects', h[0:2], h )
+
+def digest( path ):
+	
+	h = hashlib.sha1()
+	
+	f = open( path, 'rb' )
+	try:
+		while True:
+			data = f.read( copy_buffer )
+			if not data:
+				break
+			h.update( data )
+	finally:
+		f.close()
+	
+	return h.hexdigest()
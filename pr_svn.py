@@ -4,61 +4,181 @@
 import sys
 import os
 import os.path
-import tempfile
+import subprocess
+import threading
+import time
 import datetime
+import re
+import array
+import bisect
 
-from xml.dom import minidom
+try:
+	import sqlite3
+except ImportError:
+	sqlite3 = None
 
-def log( path, revision=None, empty=True, multi=False, default='GENERAL' ):
+import pr_trace
+
+try:
+	from xml.etree import cElementTree as ElementTree
+except ImportError:
+	from xml.etree import ElementTree
+
+# every svn command run, with its exit status, stderr and wall time
+commands = []
+
+# sqlite file keeping every fetched log entry, None always asks svn
+log_cache = None
+
+# writes to the log cache, from any thread, one at a time
+cache_lock = threading.Lock()
+
+# seconds a cache connection waits for another process writing to it
+cache_timeout = 60
+
+# a subtree is also looked for below these repo folders
+roots = [ 'trunk', 'levels' ]
+
+class SvnError(Exception):
+	def __init__(self, command, status, stderr=''):
+		self.command = command
+		self.status = status
+		self.stderr = stderr
+		self.msg = '%s failed with status %s: %s' % ( ' '.join( command ), status, stderr.strip() )
+	def __str__(self):
+		return self.msg
+
+def log( path, revision=None, empty=True, multi=False, default='GENERAL', subtree=None ):
+	
+	# subtree keeps only the entries that changed something below it
+	if log_cache and sqlite3 and revision:
+		entries = cached_log( path, revision, subtree )
+		if entries is not None:
+			return split_entries( entries, empty, multi, default )
 	
-	cmd = 'svn log %s -v --xml' % path
+	cmd = [ 'svn', 'log', path, '-v', '--xml' ]
 	
 	if revision:
-		cmd += ' -r %s' % revision
+		cmd += [ '-r', str( revision ) ]
 	
-	temp, abspath = tempfile.mkstemp()
-	file = os.fdopen( temp )
-	file.close()
+	entries = read_log( Pipe( cmd ) )
 	
-	os.system( '%s > %s' % ( cmd, abspath ) )
+	if subtree:
+		entries = within( entries, subtree )
 	
-	return get_log( abspath, empty, multi, default )
+	return split_entries( entries, empty, multi, default )
 
-def update( path, revision=None, quiet=True ):
+def update( path, revision=None, quiet=True, output=None ):
 	
 	if not os.path.exists( path ):
 		return False
 	
-	cmd = 'svn update %s' % path
+	cmd = [ 'svn', 'update', path ]
 	
 	if revision:
-		cmd += ' -r %s' % revision
+		cmd += [ '-r', str( revision ) ]
 	
 	if quiet:
-		cmd += ' -q'
+		cmd.append( '-q' )
 	
-	return os.system( cmd )
+	return run( cmd, output )
 
-def export( path, destination, quiet=True ):
+def export( path, destination, quiet=True, output=None ):
 	
 	if not os.path.exists( path ):
 		return False
 	
 	if not os.path.exists( destination ):
-		os.makedirs( destination )
+		try:
+			os.makedirs( destination )
+		except OSError:
+			if not os.path.isdir( destination ):
+				raise
 	
-	cmd = 'svn export %s %s --force' % ( path, destination )
+	cmd = [ 'svn', 'export', path, destination, '--force' ]
 	
 	if quiet:
-		cmd += ' -q'
+		cmd.append( '-q' )
+	
+	return run( cmd, output )
+
+def run( cmd, output=None ):
+	
+	# output names a file for the command's stdout, otherwise it goes to ours
+	start = time.time()
+	
+	if output:
+		stdout = open( output, 'w' )
+	else:
+		stdout = None
+	
+	try:
+		process = subprocess.Popen( cmd, stdout=stdout, stderr=subprocess.PIPE )
+		stderr = process.communicate()[1]
+	finally:
+		if stdout:
+			stdout.close()
+	
+	if stderr:
+		sys.stderr.write( stderr )
+	
+	return record( cmd, process.returncode, stderr, start )
+
+class Pipe(object):
 	
-	return os.system( cmd )
+	# file object over the stdout of a running svn command, so the xml is
+	# parsed while svn is still writing it. stderr is drained on a thread
+	# so a chatty svn can never block on a full pipe.
+	
+	def __init__(self, cmd):
+		self.cmd = cmd
+		self.start = time.time()
+		self.status = None
+		self.stderr = []
+		self.process = subprocess.Popen( cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE )
+		self.reader = threading.Thread( target=lambda: self.stderr.append( self.process.stderr.read() ) )
+		self.reader.setDaemon( True )
+		self.reader.start()
+	
+	def read(self, size=-1):
+		
+		data = self.process.stdout.read( size )
+		
+		if not data or size < 0:
+			self.close()
+		
+		return data
+	
+	def close(self):
+		
+		if self.status is not None:
+			return
+		
+		self.process.stdout.close()
+		self.status = self.process.wait()
+		self.reader.join()
+		
+		stderr = ''.join( self.stderr )
+		record( self.cmd, self.status, stderr, self.start )
+		
+		if self.status:
+			raise SvnError( self.cmd, self.status, stderr )
+
+def record( cmd, status, stderr, start ):
+	
+	commands.append( { 'command': cmd, 'status': status, 'stderr': stderr, 'time': time.time() - start } )
+	pr_trace.count( subprocesses=1 )
+	
+	return status
 
 def get_paths( logs, remove=['trunk'] ):
 	
-	added = []
-	modified = []
-	deleted = []
+	added = set()
+	modified = set()
+	deleted = set()
+	
+	if remove:
+		remove = [ r.strip('/') for r in remove ]
 	
 	for entry in logs:
 		for p in entry['paths']:
@@ -68,9 +188,8 @@ def get_paths( logs, remove=['trunk'] ):
 			
 			if remove:
 				for r in remove:
-					r = r.strip('/')
-					if path.startswith( r ):
-						path = path.replace( r, '' )
+					if path == r or path.startswith( r + '/' ):
+						path = path[len( r ):]
 			
 			path = path.strip('/')
 			
@@ -81,24 +200,23 @@ def get_paths( logs, remove=['trunk'] ):
 				path = path.replace( '/',os.sep )
 			
 			if action == 'D':
-				if path in added:
-					added.remove( path )
-				if path in modified:
-					modified.remove( path )
-				if path not in deleted:
-					deleted.append( path )
+				added.discard( path )
+				modified.discard( path )
+				deleted.add( path )
 			
 			elif action == 'M':
-				if path in deleted:
-					deleted.remove( path )
-				if path not in modified and path not in added:
-					modified.append( path )
+				deleted.discard( path )
+				if path not in added:
+					modified.add( path )
 			
 			elif action == 'A':
-				if path in deleted:
-					deleted.remove( path )
-				if path not in added and path not in modified:
-					added.append( path )
+				deleted.discard( path )
+				if path not in modified:
+					added.add( path )
+	
+	added = list( added )
+	modified = list( modified )
+	deleted = list( deleted )
 	
 	added.sort()
 	modified.sort()
@@ -107,55 +225,342 @@ def get_paths( logs, remove=['trunk'] ):
 	return added, modified, deleted
 
 def get_log( file, empty=True, multi=False, default='GENERAL' ):
+	return split_entries( read_log( file ), empty, multi, default )
+
+def read_log( file ):
 	
-	logs = []
-	
-	xmldoc = minidom.parse(file)
-	data = xmldoc.toxml( 'utf-8' )
-	xmldoc = minidom.parseString( data )
+	context = iter( ElementTree.iterparse( file, events=( 'start', 'end' ) ) )
+	event, root = context.next()
 	
-	for log in xmldoc.getElementsByTagName('logentry'):
+	for event, log in context:
 		
-		r = log.getAttribute('revision').encode('utf-8')
-		m = ''
+		if event != 'end' or log.tag != 'logentry':
+			continue
 		
-		try:
-			m = log.getElementsByTagName('msg')[0].firstChild.nodeValue.encode('utf-8')
-		except: pass
+		p = []
+		for path in log.getiterator('path'):
+			p.append( ( text( path.get('action') ), text( path.text ) ) )
 		
-		m = m.strip()
+		yield ( int( log.get('revision') ), text( log.findtext('author') ), text( log.findtext('date') ), text( log.findtext('msg') ), p )
 		
-		if not empty and len( m ) == 0:
-			continue
+		# drop the finished entries so memory stays flat over long ranges
+		root.clear()
+
+def within( entries, subtree ):
+	
+	candidates = nodes( subtree )
+	
+	for entry in entries:
+		for action, p in entry[4]:
+			p = p.strip( '/' )
+			if [ c for c in candidates if p == c or p.startswith( c + '/' ) ]:
+				yield entry
+				break
+
+def nodes( subtree ):
+	
+	# the repo paths a subtree may stand for
+	subtree = subtree.replace( os.sep, '/' ).strip( '/' )
+	
+	return [ subtree ] + [ '%s/%s' % ( r, subtree ) for r in roots if not subtree.startswith( r + '/' ) and subtree != r ]
+
+def split_entries( entries, empty=True, multi=False, default='GENERAL' ):
+	
+	for entry in entries:
+		for e in get_entries( entry, empty, multi, default ):
+			yield e
+
+def get_entries( entry, empty=True, multi=False, default='GENERAL' ):
+	
+	logs = []
+	
+	r, a, dt, m, p = entry
+	
+	r = str( r )
+	m = m.strip()
+	
+	if not empty and len( m ) == 0:
+		return logs
+	
+	d = dt[0:10]
+	dt = datetime.datetime( int(dt[0:4]), int(dt[5:7]), int(dt[8:10]), int(dt[11:13]), int(dt[14:16]), int(dt[17:19]) )
+	
+	c = default.upper()
+	
+	if not multi:
+		mm = m.split('\n')
+	else:
+		mm = [ m ]
+	
+	for ml in mm:
+		
+		mp = ml.strip().split(':',1)
+		if len( mp ) >= 2 and mp[0].upper() == mp[0]:
+			c = mp[0]
 		
-		d = log.getElementsByTagName('date')[0].firstChild.nodeValue.encode('utf-8')
-		d = d[0:10]
+		ml = ml.replace( c + ':', '' ).strip()
+		c  = c.strip()
 		
-		dt = log.getElementsByTagName('date')[0].firstChild.nodeValue.encode('utf-8')
-		dt = datetime.datetime( int(dt[0:4]), int(dt[5:7]), int(dt[8:10]), int(dt[11:13]), int(dt[14:16]), int(dt[17:19]) )
+		logs.append( { 'revision': r, 'category': c, 'message': ml, 'date': d, 'datetime': dt, 'author': a, 'paths': p } )
+	
+	return logs
+
+def cached_log( path, revision, subtree=None ):
+	
+	# answers a revision range from the log cache, fetching from svn only the
+	# revisions never asked for before. HEAD, dates and other keywords cost
+	# one svn info each to pin down. None means the range could not be
+	# resolved and svn log should be asked directly.
+	bounds = revision_bounds( path, revision )
 	
-		a = log.getElementsByTagName('author')[0].firstChild.nodeValue.encode('utf-8')
+	if bounds is None:
+		return None
+	
+	start, end = bounds
+	
+	key = cache_key( path )
+	db = open_cache()
+	
+	try:
 		
-		p = []
-		for path in log.getElementsByTagName('path'):
-			p.append( ( path.getAttribute('action').encode('utf-8'), path.firstChild.nodeValue.encode('utf-8') ) )
+		fill( db, key, path, min( start, end ), max( start, end ) )
 		
-		c = default.upper()
+		if start <= end:
+			order = 'ASC'
+		else:
+			order = 'DESC'
+		
+		if subtree is None:
+			rows = db.execute( 'SELECT revision, author, date, msg, paths FROM entries WHERE repo = ? AND revision BETWEEN ? AND ? ORDER BY revision %s' % order, 
+				( key, min( start, end ), max( start, end ) ) ).fetchall()
 		
-		if not multi:
-			mm = m.split('\n')
 		else:
-			mm = [ m ]
+			
+			# straight to the revisions the path index has for the subtree
+			revisions = indexed( db, key, nodes( subtree ), min( start, end ), max( start, end ) )
+			
+			rows = []
+			for i in range( 0, len( revisions ), 500 ):
+				chunk = revisions[i:i+500]
+				rows.extend( db.execute( 'SELECT revision, author, date, msg, paths FROM entries WHERE repo = ? AND revision IN ( %s )' % ','.join( [ '?' ] * len( chunk ) ), 
+					[ key ] + chunk ).fetchall() )
+			
+			rows.sort( reverse=( order == 'DESC' ) )
+	
+	finally:
+		db.close()
+	
+	entries = []
+	for r, a, d, m, p in rows:
+		paths = []
+		if p:
+			paths = [ tuple( x.split( ' ', 1 ) ) for x in p.split( '\n' ) ]
+		entries.append( ( r, a, d, m, paths ) )
+	
+	return entries
+
+def revision_bounds( path, revision ):
+	
+	bounds = re.findall( r'\{[^}]*\}|[^:{}]+', str( revision ) )
+	
+	if len( bounds ) not in ( 1, 2 ):
+		return None
+	
+	try:
+		bounds = [ revision_number( path, b ) for b in bounds ]
+	except SvnError:
+		return None
+	
+	return bounds[0], bounds[-1]
+
+def reverse_range( revision ):
+	
+	# the same range the other way round, a single revision stays as it is
+	bounds = re.findall( r'\{[^}]*\}|[^:{}]+', str( revision ) )
+	
+	if len( bounds ) != 2:
+		return revision
+	
+	return '%s:%s' % ( bounds[1], bounds[0] )
+
+def newest_first( path, revision ):
+	
+	# the range from its newest to its oldest revision whichever way it
+	# was given
+	bounds = revision_bounds( path, revision )
+	
+	if bounds is None:
+		return revision
+	
+	return '%s:%s' % ( max( bounds ), min( bounds ) )
+
+def fill( db, key, path, start, end ):
+	
+	# fetches the revisions between start and end never asked for before,
+	# svn is read with no transaction open so other threads keep writing
+	for lo, hi in missing( db, key, start, end ):
 		
-		for ml in mm:
+		rows = list( read_log( Pipe( [ 'svn', 'log', path, '-v', '--xml', '-r', '%s:%s' % ( lo, hi ) ] ) ) )
+		
+		cache_lock.acquire()
+		try:
 			
-			mp = ml.strip().split(':',1)
-			if len( mp ) >= 2 and mp[0].upper() == mp[0]:
-				c = mp[0]
+			entries = []
+			for r, a, d, m, p in rows:
+				db.execute( 'INSERT OR REPLACE INTO entries VALUES ( ?, ?, ?, ?, ?, ? )', 
+					( key, r, a, d, m, '\n'.join( [ '%s %s' % x for x in p ] ) ) )
+				entries.append( ( r, [ x[1] for x in p ] ) )
 			
-			ml = ml.replace( c + ':', '' ).strip()
-			c  = c.strip()
+			index( db, key, entries )
 			
-			logs.append( { 'revision': r, 'category': c, 'message': ml, 'date': d, 'datetime': dt, 'author': a, 'paths': p } )
+			db.execute( 'INSERT INTO ranges VALUES ( ?, ?, ? )', ( key, lo, hi ) )
+			db.commit()
+		
+		except:
+			db.rollback()
+			raise
+		
+		finally:
+			cache_lock.release()
+
+def index( db, key, entries ):
 	
-	return logs
+	# adds ( revision, changed paths ) to the path index: every folder on the
+	# way to a changed path keeps the sorted revisions that changed below it
+	added = {}
+	
+	for r, paths in entries:
+		for p in paths:
+			
+			parts = p.strip( '/' ).split( '/' )
+			
+			for i in range( 1, len( parts ) + 1 ):
+				node = '/'.join( parts[0:i] )
+				if node not in added:
+					added[node] = set()
+				added[node].add( r )
+	
+	for node, revisions in added.iteritems():
+		
+		row = db.execute( 'SELECT revisions FROM nodes WHERE repo = ? AND path = ?', ( key, node ) ).fetchone()
+		if row:
+			revisions.update( unpack( row[0] ) )
+		
+		db.execute( 'INSERT OR REPLACE INTO nodes VALUES ( ?, ?, ?, ? )', ( key, node, node.rpartition( '/' )[0], pack( revisions ) ) )
+
+def indexed( db, key, candidates, start, end ):
+	
+	# revisions between start and end that changed something below any candidate
+	revisions = set()
+	
+	for node in candidates:
+		
+		row = db.execute( 'SELECT revisions FROM nodes WHERE repo = ? AND path = ?', ( key, node ) ).fetchone()
+		if not row:
+			continue
+		
+		r = unpack( row[0] )
+		revisions.update( r[bisect.bisect_left( r, start ):bisect.bisect_right( r, end )] )
+	
+	revisions = list( revisions )
+	revisions.sort()
+	
+	return revisions
+
+def pack( revisions ):
+	
+	revisions = list( revisions )
+	revisions.sort()
+	
+	return sqlite3.Binary( array.array( 'i', revisions ).tostring() )
+
+def unpack( blob ):
+	
+	revisions = array.array( 'i' )
+	revisions.fromstring( str( blob ) )
+	
+	return revisions
+
+def revision_number( path, revision ):
+	
+	if revision.isdigit():
+		return int( revision )
+	
+	info = Pipe( [ 'svn', 'info', path, '--xml', '-r', revision ] )
+	number = ElementTree.parse( info ).getroot().find( 'entry' ).get( 'revision' )
+	info.close()
+	
+	return int( number )
+
+def cache_key( path ):
+	
+	if '://' in path:
+		return path.rstrip( '/' )
+	
+	return os.path.abspath( path )
+
+def open_cache():
+	
+	folder = os.path.dirname( os.path.abspath( log_cache ) )
+	if not os.path.exists( folder ):
+		os.makedirs( folder )
+	
+	db = sqlite3.connect( log_cache, timeout=cache_timeout )
+	db.text_factory = str
+	
+	cache_lock.acquire()
+	try:
+		create_cache( db )
+	finally:
+		cache_lock.release()
+	
+	return db
+
+def create_cache( db ):
+	
+	db.execute( 'CREATE TABLE IF NOT EXISTS entries ( repo TEXT, revision INTEGER, author TEXT, date TEXT, msg TEXT, paths TEXT, PRIMARY KEY ( repo, revision ) )' )
+	db.execute( 'CREATE INDEX IF NOT EXISTS entries_date ON entries ( repo, date )' )
+	db.execute( 'CREATE INDEX IF NOT EXISTS entries_author ON entries ( repo, author )' )
+	db.execute( 'CREATE TABLE IF NOT EXISTS ranges ( repo TEXT, first INTEGER, last INTEGER )' )
+	
+	# caches from before the path index get it built from their entries
+	if not db.execute( "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'nodes'" ).fetchone():
+		
+		db.execute( 'CREATE TABLE nodes ( repo TEXT, path TEXT, parent TEXT, revisions BLOB, PRIMARY KEY ( repo, path ) )' )
+		db.execute( 'CREATE INDEX nodes_parent ON nodes ( repo, parent )' )
+		
+		repos = {}
+		for key, r, p in db.execute( 'SELECT repo, revision, paths FROM entries' ):
+			if key not in repos:
+				repos[key] = []
+			repos[key].append( ( r, [ x.split( ' ', 1 )[-1] for x in p.split( '\n' ) if x ] ) )
+		
+		for key, entries in repos.iteritems():
+			index( db, key, entries )
+		
+		db.commit()
+
+def missing( db, key, start, end ):
+	
+	# revision ranges between start and end that were never fetched
+	gaps = []
+	
+	for lo, hi in db.execute( 'SELECT first, last FROM ranges WHERE repo = ? AND last >= ? AND first <= ? ORDER BY first', ( key, start, end ) ):
+		if lo > start:
+			gaps.append( ( start, lo - 1 ) )
+		start = max( start, hi + 1 )
+	
+	if start <= end:
+		gaps.append( ( start, end ) )
+	
+	return gaps
+
+def text( value ):
+	
+	if value is None:
+		return ''
+	
+	if isinstance( value, unicode ):
+		return value.encode('utf-8')
+	
+	return value
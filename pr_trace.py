@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import os.path
+import time
+import threading
+
+try:
+	import json
+except ImportError:
+	json = None
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+# finished phases, in the order they ended
+phases = []
+
+lock  = threading.Lock()
+local = threading.local()
+
+origin = time.time()
+
+def begin( name, args=() ):
+	
+	phase = {
+		'name': name,
+		'args': [ str( a ) for a in args ],
+		'thread': threading.currentThread().getName(),
+		'start': time.time(),
+		'cpu': cpu(),
+		'files': 0,
+		'bytes': 0,
+		'subprocesses': 0
+	}
+	
+	stack().append( phase )
+	
+	return phase
+
+def end( phase ):
+	
+	s = stack()
+	if phase in s:
+		s.remove( phase )
+	
+	phase['wall'] = time.time() - phase['start']
+	phase['cpu'] = cpu() - phase['cpu']
+	
+	lock.acquire()
+	try:
+		phases.append( phase )
+	finally:
+		lock.release()
+	
+	return phase
+
+def run( name, function, *args ):
+	
+	phase = begin( name, args )
+	try:
+		return function( *args )
+	finally:
+		end( phase )
+
+def traced( name, function ):
+	
+	# function wrapped so every call is a phase named after its arguments
+	def call( *args ):
+		return run( name, function, *args )
+	
+	return call
+
+def count( files=0, bytes=0, subprocesses=0 ):
+	
+	# adds to every phase running on this thread, so nested phases add up
+	lock.acquire()
+	try:
+		for phase in stack():
+			phase['files'] += files
+			phase['bytes'] += bytes
+			phase['subprocesses'] += subprocesses
+	finally:
+		lock.release()
+
+def context():
+	return list( stack() )
+
+def attach( phases ):
+	
+	# worker threads count towards the phases of the thread that started them
+	local.stack = list( phases )
+
+def stack():
+	
+	if not hasattr( local, 'stack' ):
+		local.stack = []
+	
+	return local.stack
+
+def cpu():
+	
+	# process wide, phases running at the same time share it. Windows has no
+	# resource module and its time.clock() is wall time, os.times() gives
+	# user and system time of this process there (children are not counted)
+	if resource:
+		s = resource.getrusage( resource.RUSAGE_SELF )
+		c = resource.getrusage( resource.RUSAGE_CHILDREN )
+		return s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime
+	
+	t = os.times()
+	
+	return t[0] + t[1] + t[2] + t[3]
+
+def label( phase ):
+	return ' '.join( [ phase['name'] ] + phase['args'] )
+
+def write( path ):
+	
+	# chrome trace event format, open with chrome://tracing or perfetto
+	if not json:
+		return
+	
+	threads = {}
+	events  = []
+	
+	for phase in phases:
+		
+		if phase['thread'] not in threads:
+			threads[phase['thread']] = len( threads ) + 1
+			events.append( { 'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': threads[phase['thread']], 'args': { 'name': phase['thread'] } } )
+		
+		events.append( {
+			'name': label( phase ),
+			'cat': phase['name'],
+			'ph': 'X',
+			'pid': 1,
+			'tid': threads[phase['thread']],
+			'ts': int( ( phase['start'] - origin ) * 10 ** 6 ),
+			'dur': int( phase['wall'] * 10 ** 6 ),
+			'args': {
+				'cpu': round( phase['cpu'], 3 ),
+				'files': phase['files'],
+				'bytes': phase['bytes'],
+				'subprocesses': phase['subprocesses']
+			}
+		} )
+	
+	folder = os.path.dirname( path )
+	if folder and not os.path.exists( folder ):
+		os.makedirs( folder )
+	
+	f = open( path, 'w' )
+	json.dump( { 'traceEvents': events, 'displayTimeUnit': 'ms' }, f )
+	f.close()
+
+def summary():
+	
+	lines = []
+	lines.append( '%-16s %10s %10s %8s %10s %6s' % ( 'phase', 'wall', 'cpu', 'files', 'MB', 'procs' ) )
+	
+	totals = {}
+	names  = []
+	
+	for phase in sorted( phases, key=lambda p: p['start'] ):
+		
+		lines.append( row( label( phase ), phase ) )
+		
+		if phase['name'] not in totals:
+			totals[phase['name']] = { 'wall': 0, 'cpu': 0, 'files': 0, 'bytes': 0, 'subprocesses': 0 }
+			names.append( phase['name'] )
+		
+		for key in totals[phase['name']].keys():
+			totals[phase['name']][key] += phase[key]
+	
+	lines.append( '' )
+	
+	for name in names:
+		lines.append( row( '%s total' % name, totals[name] ) )
+	
+	return lines
+
+def row( name, phase ):
+	return '%-16s %9.2fs %9.2fs %8s %10.1f %6s' % ( name, phase['wall'], phase['cpu'], phase['files'], phase['bytes'] / 1048576.0, phase['subprocesses'] )
@@ -6,9 +6,37 @@ import os
 import os.path
 import stat
 import fnmatch
+import errno
+import re
+import shutil
+import threading
+import Queue
+
+try:
+	import multiprocessing
+except ImportError:
+	multiprocessing = None
+
+try:
+	import ctypes
+except ImportError:
+	ctypes = None
+
+import time
 
 from time import sleep
 
+import pr_trace
+
+copy_workers = 8
+copy_buffer  = 1024 * 1024
+
+rename_delay   = False
+rename_timeout = 30
+
+# python 2 on windows has no os.link, the windows api links there instead
+hard_links = hasattr( os, 'link' ) or ( ctypes is not None and hasattr( ctypes, 'WinDLL' ) )
+
 def rename( source, destination, verbose=False ):
 	
 	if not os.path.exists( source ):
@@ -17,9 +45,30 @@ def rename( source, destination, verbose=False ):
 	if verbose:
 		print 'Renaming %s to %s' % ( source, destination )
 	
-	os.rename( source, destination )
-	delay()
-	# os.system( 'ren %s %s' % ( source, destination ) )
+	start = time.time()
+	pause = 0.01
+	
+	while True:
+		try:
+			os.rename( source, destination )
+			break
+		except OSError, e:
+			# sharing violations (antivirus, indexer, explorer) show up as access denied
+			if e.errno not in ( errno.EACCES, errno.EBUSY ) or time.time() - start > rename_timeout:
+				raise
+		sleep( pause )
+		pause = min( pause * 2, 1 )
+	
+	same = os.path.normcase( os.path.abspath( source ) ) == os.path.normcase( os.path.abspath( destination ) )
+	
+	while ( os.path.exists( source ) and not same ) or not os.path.exists( destination ):
+		if time.time() - start > rename_timeout:
+			raise OSError( errno.EIO, 'Renaming %s to %s did not complete' % ( source, destination ) )
+		sleep( pause )
+		pause = min( pause * 2, 1 )
+	
+	if rename_delay:
+		delay()
 
 def paths( path, pattern='*', recursive=False, exclude=[] ):
 	
@@ -88,56 +137,354 @@ def delete( path, pattern=None, recursive=False, exclude=[], verbose=False ):
 		if os.path.isdir( path ):
 			for root, dirs, files in os.walk(path, topdown=False):
 				for name in files:
-					os.chmod(os.path.join(root, name), stat.S_IWRITE)
+					writable(os.path.join(root, name))
 					os.remove(os.path.join(root, name))
 				for name in dirs:
 					os.rmdir(os.path.join(root, name))
 			os.rmdir(path)
 			# os.system( 'rd /S %s %s' % ( q, path ) )
 		else:
-			os.chmod(path, stat.S_IWRITE)
+			writable(path)
 			os.remove(path)
 			# os.system( 'del /F %s %s %s' % ( q, r, path ) )
 		
-def copy( source, destination, verbose=False ):
+def writable( path ):
+	
+	# only touch read-only files, a hard linked file shares its mode with
+	# every other link to it
+	if not os.access( path, os.W_OK ):
+		os.chmod( path, stat.S_IWRITE | stat.S_IREAD )
 
-	if not os.path.exists( source ):
-		return
+def prune( path, pattern, recursive=True, exclude=[], empty=False, verbose=False ):
 	
-	if not os.path.exists( os.path.dirname( destination ) ):
-		os.makedirs( os.path.dirname( destination ) )
+	if not os.path.isdir( path ):
+		return []
 	
-	if not os.path.isdir( source ):
+	if verbose:
+		print 'Pruning %s patterns %s recursive %s exclude %s' % ( path, pattern, recursive, exclude )
+	
+	removed = []
+	prune_dir( path, patterns( pattern ), patterns( exclude ), recursive, empty, removed, verbose )
+	
+	return removed
+
+def prune_dir( path, include, exclude, recursive, empty, removed, verbose=False ):
+	
+	changed = False
+	
+	for name in os.listdir( path ):
 		
-		if verbose:
-			print 'Copying %s to %s' % ( source, destination )
+		if name == '.svn':
+			continue
 		
-		if os.name in ['posix','mac']:
-			os.system( 'cp -f "%s" "%s"' % ( source, destination ) )
-		else:
-			os.system( 'copy "%s" "%s" /Y' % ( source, destination ) )
-		return
+		full = os.path.join( path, name )
+		n = os.path.normcase( name )
+		
+		if include and include.match( n ) and not ( exclude and exclude.match( n ) ):
+			
+			if verbose:
+				print 'Deleting %s' % full
+			
+			delete( full )
+			removed.append( full )
+			changed = True
+		
+		elif recursive and os.path.isdir( full ) and not os.path.islink( full ):
+			
+			pruned = prune_dir( full, include, exclude, recursive, empty, removed, verbose )
+			
+			if ( empty or pruned ) and not os.listdir( full ):
+				
+				if verbose:
+					print 'Deleting empty dir %s' % full
+				
+				os.rmdir( full )
+				removed.append( full )
+				pruned = True
+			
+			if pruned:
+				changed = True
 	
-	for root, dirs, files in os.walk( source ):
+	return changed
+
+def patterns( list ):
+	
+	if not list:
+		return None
+	
+	if isinstance( list, basestring ):
+		list = [ list ]
+	
+	return re.compile( '|'.join( [ '(?:%s)' % fnmatch.translate( os.path.normcase( p ) ) for p in list ] ) )
+
+class Filter(object):
+	
+	# declarative exclusion rules for copy and merge, each rule is
+	# ( folder, patterns, recursive, exclude ) like the prune arguments.
+	# Matched paths are counted per rule with the bytes they would take.
+	
+	def __init__(self, rules):
 		
-		if '.svn' in dirs:
-			dirs.remove( '.svn' )
+		self.rules = []
 		
-		pref = os.path.commonprefix( ( source, root ) )
-		s = os.path.join( root )
-		d = os.path.join( destination, root.replace( pref, '' ).strip(os.sep) )
+		for folder, pattern, recursive, exclude in rules:
+			folder = os.path.normcase( os.path.normpath( folder ) ).strip( os.sep )
+			if folder == os.curdir:
+				folder = ''
+			self.rules.append( ( folder, patterns( pattern ), recursive, patterns( exclude ), ( folder, pattern, recursive, exclude ) ) )
 		
-		for name in files:
-			copy( os.path.join( s, name ), os.path.join( d, name ), verbose )
+		self.files = [ 0 ] * len( self.rules )
+		self.bytes = [ 0 ] * len( self.rules )
+	
+	def __call__(self, path, source=None):
+		
+		path = os.path.normcase( path ).strip( os.sep )
+		parent, name = os.path.split( path )
 		
-		for name in dirs:
-			if not os.path.exists( os.path.join( d, name ) ):
+		for i in range( 0, len( self.rules ) ):
+			
+			folder, include, recursive, exclude, rule = self.rules[i]
+			
+			if parent != folder and not ( recursive and ( folder == '' or parent.startswith( folder + os.sep ) ) ):
+				continue
+			
+			if include and include.match( name ) and not ( exclude and exclude.match( name ) ):
 				
-				if verbose:
-					print 'Creating dir %s' % os.path.join( d, name )
-				os.makedirs( os.path.join( d, name ) )
+				if source:
+					self.files[i] += file_count( source )
+					self.bytes[i] += size( source )
+				
+				return True
+		
+		return False
+	
+	def report(self):
+		
+		lines = []
+		
+		for i in range( 0, len( self.rules ) ):
+			folder, pattern, recursive, exclude = self.rules[i][4]
+			lines.append( '%10.1f MB %6s files  %s %s recursive %s exclude %s' % ( self.bytes[i] / 1048576.0, self.files[i], folder or '.', pattern, recursive, exclude ) )
+		
+		lines.append( '%10.1f MB %6s files  total' % ( sum( self.bytes ) / 1048576.0, sum( self.files ) ) )
+		
+		return lines
+
+def copy( source, destination, verbose=False, link=False, exclude=None ):
+	
+	# link stages the tree as hard links (copying where the file system
+	# can not link), exclude( relative path, source path ) skips matching paths
+	if not os.path.exists( source ):
+		return
+	
+	start = time.time()
+	
+	jobs = []
+	dirs = [ os.path.dirname( destination ) ]
+	
+	if not os.path.isdir( source ):
+		jobs.append( ( source, destination, verbose ) )
+	
+	else:
+		for root, subdirs, files in os.walk( source ):
+			
+			if '.svn' in subdirs:
+				subdirs.remove( '.svn' )
+			
+			r = root[len( source ):].strip( os.sep )
+			d = os.path.join( destination, r )
+			
+			if exclude:
+				subdirs[:] = [ name for name in subdirs if not exclude( os.path.join( r, name ), os.path.join( root, name ) ) ]
+				files = [ name for name in files if not exclude( os.path.join( r, name ), os.path.join( root, name ) ) ]
+			
+			if files:
+				dirs.append( d )
+			
+			for name in files:
+				jobs.append( ( os.path.join( root, name ), os.path.join( d, name ), verbose ) )
+			
+			# folders left empty by the filter are still created, like the
+			# deletes after a full copy used to leave them
+			for name in subdirs:
+				dirs.append( os.path.join( d, name ) )
+	
+	for d in dirs:
+		if d and not os.path.exists( d ):
+			
+			if verbose:
+				print 'Creating dir %s' % d
+			makedirs( d )
+	
+	if link:
+		function = link_file
+	else:
+		function = copy_file
+	
+	size = 0
+	for s in pool( function, jobs, copy_workers ):
+		size += s
+	
+	pr_trace.count( len( jobs ), size )
+	
+	elapsed = max( time.time() - start, 0.001 )
+	
+	if verbose and len( jobs ) > 1:
+		if link:
+			action = 'Staged'
+		else:
+			action = 'Copied'
+		print '%s %s files (%.1f MB) in %.2fs, %.0f files/s, %.1f MB/s' % ( action, len( jobs ), size / 1048576.0, elapsed, len( jobs ) / elapsed, size / 1048576.0 / elapsed )
+	
+	return len( jobs ), size
+
+def copy_file( job ):
+	
+	source, destination, verbose = job
+	
+	if verbose:
+		print 'Copying %s to %s' % ( source, destination )
+	
+	# never write through an existing file, it may be a hard link into a cache
+	if os.path.exists( destination ):
+		writable( destination )
+		os.remove( destination )
+	
+	s = open( source, 'rb' )
+	try:
+		d = open( destination, 'wb' )
+		try:
+			shutil.copyfileobj( s, d, copy_buffer )
+			size = d.tell()
+		finally:
+			d.close()
+	finally:
+		s.close()
+	
+	return size
+
+def link( source, destination, verbose=False ):
+	
+	if verbose:
+		print 'Linking %s to %s' % ( source, destination )
+	
+	if os.path.exists( destination ):
+		writable( destination )
+		os.remove( destination )
+	
+	try:
+		hardlink( source, destination )
+	except ( AttributeError, OSError ):
+		return copy_file( ( source, destination, False ) )
+	
+	return os.path.getsize( destination )
 
-def merge( source, destination, verbose=False ):
+def hardlink( source, destination ):
+	
+	# os.link where there is one, CreateHardLinkW otherwise. Raises OSError
+	# when the file system can not link, AttributeError when the os can not.
+	if hasattr( os, 'link' ):
+		return os.link( source, destination )
+	
+	if not hard_links:
+		raise AttributeError( 'os.link' )
+	
+	source = unicode_path( source )
+	destination = unicode_path( destination )
+	
+	kernel32 = ctypes.WinDLL( 'kernel32', use_last_error=True )
+	
+	if not kernel32.CreateHardLinkW( destination, source, None ):
+		raise ctypes.WinError( ctypes.get_last_error() )
+
+def file_info( path ):
+	
+	# ( identity, links ) of a file: device and inode, or on windows, where
+	# python 2 stat has neither, volume serial and file index
+	if hasattr( os, 'link' ) or not hard_links:
+		s = os.lstat( path )
+		return ( s.st_dev, s.st_ino ), s.st_nlink
+	
+	kernel32 = ctypes.WinDLL( 'kernel32', use_last_error=True )
+	kernel32.CreateFileW.restype = ctypes.c_void_p
+	kernel32.GetFileInformationByHandle.argtypes = [ ctypes.c_void_p, ctypes.c_void_p ]
+	kernel32.CloseHandle.argtypes = [ ctypes.c_void_p ]
+	
+	# no access asked, only the attributes are read
+	handle = kernel32.CreateFileW( unicode_path( path ), 0, 7, None, 3, 0x02000000, None )
+	if handle is None or handle == ctypes.c_void_p( -1 ).value:
+		raise ctypes.WinError( ctypes.get_last_error() )
+	
+	# BY_HANDLE_FILE_INFORMATION: serial at 7, links at 10, index at 11 and 12
+	info = ( ctypes.c_uint32 * 13 )()
+	try:
+		if not kernel32.GetFileInformationByHandle( handle, ctypes.byref( info ) ):
+			raise ctypes.WinError( ctypes.get_last_error() )
+	finally:
+		kernel32.CloseHandle( handle )
+	
+	return ( info[7], info[11], info[12] ), info[10]
+
+def unicode_path( path ):
+	
+	if isinstance( path, unicode ):
+		return path
+	
+	return path.decode( sys.getfilesystemencoding() or 'mbcs' )
+
+def link_file( job ):
+	
+	source, destination, verbose = job
+	
+	return link( source, destination, verbose )
+
+def stage( files, verbose=False ):
+	
+	# materializes ( source, destination ) pairs as hard links, copying
+	# only where the file system cannot link
+	dirs = {}
+	for source, destination in files:
+		dirs[os.path.dirname( destination )] = True
+	
+	for d in dirs.keys():
+		if d and not os.path.exists( d ):
+			
+			if verbose:
+				print 'Creating dir %s' % d
+			makedirs( d )
+	
+	size = 0
+	for s in pool( link_file, [ ( source, destination, verbose ) for source, destination in files ], copy_workers ):
+		size += s
+	
+	pr_trace.count( len( files ), size )
+	
+	return len( files ), size
+
+def bins( items, limit ):
+	
+	# first-fit decreasing: items are ( size, ... ) tuples, the result is a
+	# list of bins whose sizes add up to at most limit
+	packed = []
+	free = []
+	
+	items = list( items )
+	items.sort( reverse=True )
+	
+	for item in items:
+		
+		for i in range( 0, len( packed ) ):
+			if item[0] <= free[i]:
+				packed[i].append( item )
+				free[i] -= item[0]
+				break
+		else:
+			packed.append( [ item ] )
+			free.append( limit - item[0] )
+	
+	return packed
+
+def merge( source, destination, verbose=False, link=False, exclude=None ):
 	
 	if not os.path.exists( source ):
 		return
@@ -145,10 +492,249 @@ def merge( source, destination, verbose=False ):
 	if verbose:
 		print 'Merging %s to %s' % ( source, destination )
 	
-	if os.name in ['posix','mac']:
-		copy( source, destination, verbose )
-	else:
-		os.system( 'xcopy "%s" "%s" /E /Q /I /Y' % ( source, destination ) )
+	return copy( source, destination, verbose, link, exclude )
+
+def pool( function, items, workers=None ):
+	
+	if workers is None:
+		workers = copy_workers
+	
+	results = [ None ] * len( items )
+	
+	if workers <= 1 or len( items ) <= 1:
+		for i in range( 0, len( items ) ):
+			results[i] = function( items[i] )
+		return results
+	
+	queue  = Queue.Queue()
+	errors = []
+	phases = pr_trace.context()
+	
+	for i in range( 0, len( items ) ):
+		queue.put( i )
+	
+	def worker():
+		pr_trace.attach( phases )
+		while not errors:
+			try:
+				i = queue.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				results[i] = function( items[i] )
+			except:
+				errors.append( sys.exc_info() )
+	
+	threads = []
+	for i in range( 0, min( workers, len( items ) ) ):
+		t = threading.Thread( target=worker )
+		t.setDaemon( True )
+		t.start()
+		threads.append( t )
+	
+	for t in threads:
+		t.join()
+	
+	if errors:
+		raise errors[0][0], errors[0][1], errors[0][2]
+	
+	return results
+
+def schedule( stages, workers=None ):
+	
+	# runs ( name, function, args, dependencies ) stages on a thread pool as
+	# soon as their dependencies are done, in list order among the ready
+	# ones. Unknown dependencies are ignored. The first failure stops new
+	# stages from starting and is raised once the running ones finish.
+	# Returns the seconds each stage took.
+	
+	if workers is None:
+		workers = copy_workers
+	
+	names = {}
+	for s in stages:
+		names[s[0]] = True
+	
+	pending = [ ( name, function, args, [ d for d in deps if d in names ] ) for name, function, args, deps in stages ]
+	done    = {}
+	running = {}
+	errors  = []
+	lock    = threading.Condition()
+	
+	def ready():
+		for s in pending:
+			for d in s[3]:
+				if d not in done:
+					break
+			else:
+				return s
+		return None
+	
+	def worker():
+		lock.acquire()
+		try:
+			while pending and not errors:
+				
+				s = ready()
+				
+				if s is None:
+					if not running:
+						errors.append( ( ValueError, ValueError( 'Stages %s can never run' % ', '.join( [ p[0] for p in pending ] ) ), None ) )
+						lock.notifyAll()
+						return
+					lock.wait()
+					continue
+				
+				pending.remove( s )
+				running[s[0]] = True
+				
+				lock.release()
+				try:
+					start = time.time()
+					try:
+						s[1]( *s[2] )
+						error = None
+					except:
+						error = sys.exc_info()
+					elapsed = time.time() - start
+				finally:
+					lock.acquire()
+				
+				del running[s[0]]
+				
+				if error:
+					errors.append( error )
+				else:
+					done[s[0]] = elapsed
+				
+				lock.notifyAll()
+		finally:
+			lock.release()
+	
+	threads = []
+	for i in range( 0, max( 1, min( workers, len( stages ) ) ) ):
+		t = threading.Thread( target=worker )
+		t.setDaemon( True )
+		t.start()
+		threads.append( t )
+	
+	for t in threads:
+		t.join()
+	
+	if errors:
+		raise errors[0][0], errors[0][1], errors[0][2]
+	
+	return done
+
+def critical_path( stages, weights ):
+	
+	# longest chain of dependent stages by weight (seconds), as
+	# ( total, [ names ] )
+	names = {}
+	for s in stages:
+		names[s[0]] = s
+	
+	finish = {}
+	
+	def longest( name ):
+		
+		if name not in finish:
+			
+			best = ( 0, [] )
+			for d in names[name][3]:
+				if d in names:
+					best = max( best, longest( d ) )
+			
+			finish[name] = ( best[0] + weights.get( name, 0 ), best[1] + [ name ] )
+		
+		return finish[name]
+	
+	path = ( 0, [] )
+	for s in stages:
+		path = max( path, longest( s[0] ) )
+	
+	return path
+
+def processes( function, items, workers=None, shared=None ):
+	
+	# shared is a pool from process_pool(), the only way to run processes
+	# while other threads are running: forking then can leave a child
+	# waiting forever on a lock some other thread held
+	if shared is not None and len( items ) > 1:
+		return shared.map( function, items, 1 )
+	
+	if workers is None:
+		workers = cpu_count()
+	
+	if workers <= 1 or len( items ) <= 1 or not multiprocessing:
+		return map( function, items )
+	
+	workers = multiprocessing.Pool( min( workers, len( items ) ) )
+	try:
+		results = workers.map( function, items, 1 )
+	except:
+		workers.terminate()
+		workers.join()
+		raise
+	
+	workers.close()
+	workers.join()
+	
+	return results
+
+def process_pool( workers=None ):
+	
+	# to be made before any thread starts, None when processes() would not
+	# use processes anyway
+	if workers is None:
+		workers = cpu_count()
+	
+	if workers <= 1 or not multiprocessing:
+		return None
+	
+	return multiprocessing.Pool( workers )
+
+def cpu_count():
+	
+	if multiprocessing:
+		try:
+			return multiprocessing.cpu_count()
+		except NotImplementedError:
+			pass
+	
+	return 1
+
+def makedirs( path ):
+	
+	# other threads may be creating the same parents
+	try:
+		os.makedirs( path )
+	except OSError, e:
+		if e.errno != errno.EEXIST or not os.path.isdir( path ):
+			raise
+
+def size( path ):
+	
+	if not os.path.isdir( path ):
+		return os.path.getsize( path )
+	
+	total = 0
+	for root, dirs, files in os.walk( path ):
+		for name in files:
+			total += os.path.getsize( os.path.join( root, name ) )
+	
+	return total
+
+def file_count( path ):
+	
+	if not os.path.isdir( path ):
+		return 1
+	
+	total = 0
+	for root, dirs, names in os.walk( path ):
+		total += len( names )
+	
+	return total
 
 def delay():
 	sleep(10)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import pr_utils
+
+class BinsTest(unittest.TestCase):
+	
+	def test_empty(self):
+		self.assertEqual( pr_utils.bins( [], 10 ), [] )
+	
+	def test_limit(self):
+		
+		items = [ ( size, 'item%s' % i ) for i, size in enumerate( [ 7, 5, 4, 3, 3, 2, 1, 1 ] ) ]
+		packed = pr_utils.bins( items, 10 )
+		
+		self.assertEqual( sorted( [ item for b in packed for item in b ] ), sorted( items ) )
+		
+		for b in packed:
+			self.assertTrue( sum( [ item[0] for item in b ] ) <= 10 )
+		
+		# first-fit decreasing: 7+3, 5+4+1, 3+2+1
+		self.assertEqual( [ [ item[0] for item in b ] for b in packed ], [ [ 7, 3 ], [ 5, 4, 1 ], [ 3, 2, 1 ] ] )
+	
+	def test_oversized(self):
+		
+		# an item over the limit gets a bin of its own
+		packed = pr_utils.bins( [ ( 15, 'big' ), ( 2, 'a' ), ( 3, 'b' ) ], 10 )
+		
+		self.assertEqual( packed, [ [ ( 15, 'big' ) ], [ ( 3, 'b' ), ( 2, 'a' ) ] ] )
+
+class FilterTest(unittest.TestCase):
+	
+	def setUp(self):
+		
+		self.path = tempfile.mkdtemp()
+		
+		for name, data in [ ( 'a.psd', 'x' * 100 ), ( 'b.psd', 'x' * 50 ), ( 'c.max', 'x' * 10 ) ]:
+			f = open( os.path.join( self.path, name ), 'wb' )
+			f.write( data )
+			f.close()
+	
+	def tearDown(self):
+		shutil.rmtree( self.path )
+	
+	def source(self, name):
+		return os.path.join( self.path, name )
+	
+	def test_folders(self):
+		
+		exclude = pr_utils.Filter( [
+			( 'objects', '*.psd', True, [] ),
+			( 'menu', '*.max', False, [] ),
+		] )
+		
+		self.assertTrue( exclude( os.path.join( 'objects', 'a.psd' ) ) )
+		self.assertTrue( exclude( os.path.join( 'objects', 'vehicles', 'a.psd' ) ) )
+		self.assertFalse( exclude( os.path.join( 'objectsx', 'a.psd' ) ) )
+		self.assertFalse( exclude( 'a.psd' ) )
+		
+		self.assertTrue( exclude( os.path.join( 'menu', 'c.max' ) ) )
+		self.assertFalse( exclude( os.path.join( 'menu', 'sub', 'c.max' ) ) )
+		self.assertFalse( exclude( os.path.join( 'menu', 'c.psd' ) ) )
+	
+	def test_exclude(self):
+		
+		exclude = pr_utils.Filter( [ ( '.', '*.psd', True, [ 'keep*' ] ) ] )
+		
+		self.assertTrue( exclude( os.path.join( 'levels', 'a.psd' ) ) )
+		self.assertTrue( exclude( 'a.psd' ) )
+		self.assertFalse( exclude( os.path.join( 'levels', 'keep.psd' ) ) )
+	
+	def test_report(self):
+		
+		# the first matching rule counts the path
+		exclude = pr_utils.Filter( [
+			( '', '*.psd', True, [] ),
+			( '', '*', True, [] ),
+		] )
+		
+		self.assertTrue( exclude( 'a.psd', self.source( 'a.psd' ) ) )
+		self.assertTrue( exclude( 'b.psd', self.source( 'b.psd' ) ) )
+		self.assertTrue( exclude( 'c.max', self.source( 'c.max' ) ) )
+		self.assertTrue( exclude( 'folder', self.path ) )
+		
+		self.assertEqual( exclude.files, [ 2, 4 ] )
+		self.assertEqual( exclude.bytes, [ 150, 170 ] )
+		
+		report = exclude.report()
+		
+		self.assertEqual( len( report ), 3 )
+		self.assertTrue( report[0].endswith( '2 files  . *.psd recursive True exclude []' ) )
+		self.assertTrue( report[2].endswith( '6 files  total' ) )
+
+class ScheduleTest(unittest.TestCase):
+	
+	def run_stages(self, stages, workers):
+		
+		self.order = []
+		self.lock = threading.Lock()
+		
+		return pr_utils.schedule( stages, workers )
+	
+	def stage(self, name, delay=0):
+		
+		if delay:
+			time.sleep( delay )
+		
+		self.lock.acquire()
+		self.order.append( name )
+		self.lock.release()
+	
+	def fail(self, name):
+		raise IOError( 'stage %s failed' % name )
+	
+	def test_dependencies(self):
+		
+		for workers in [ 1, 3 ]:
+			
+			done = self.run_stages( [
+				( 'merge', self.stage, ( 'merge', 0.05 ), [ 'core', 'levels' ] ),
+				( 'core', self.stage, ( 'core', 0.02 ), [] ),
+				( 'levels', self.stage, ( 'levels', ), [ 'missing' ] ),
+				( 'zip', self.stage, ( 'zip', ), [ 'merge' ] ),
+			], workers )
+			
+			self.assertEqual( sorted( done.keys() ), [ 'core', 'levels', 'merge', 'zip' ] )
+			self.assertEqual( self.order[2:], [ 'merge', 'zip' ] )
+			self.assertEqual( sorted( self.order[0:2] ), [ 'core', 'levels' ] )
+	
+	def test_failure(self):
+		
+		for workers in [ 1, 3 ]:
+			
+			stages = [
+				( 'core', self.fail, ( 'core', ), [] ),
+				( 'levels', self.stage, ( 'levels', 0.05 ), [] ),
+				( 'merge', self.stage, ( 'merge', ), [ 'core', 'levels' ] ),
+			]
+			
+			self.assertRaises( IOError, self.run_stages, stages, workers )
+			self.assertTrue( 'merge' not in self.order )
+	
+	def test_cycle(self):
+		
+		stages = [
+			( 'a', self.stage, ( 'a', ), [ 'b' ] ),
+			( 'b', self.stage, ( 'b', ), [ 'a' ] ),
+		]
+		
+		self.assertRaises( ValueError, self.run_stages, stages, 2 )
+
+class PruneTest(unittest.TestCase):
+	
+	def setUp(self):
+		
+		self.path = tempfile.mkdtemp()
+		
+		for name in [ 'a.tmp', 'keep.tmp', 'b.con', 'sub/c.tmp', 'sub/deep/d.tmp', 'other/e.con', '.svn/f.tmp' ]:
+			full = os.path.join( self.path, *name.split( '/' ) )
+			pr_utils.makedirs( os.path.dirname( full ) )
+			open( full, 'wb' ).close()
+		
+		os.mkdir( os.path.join( self.path, 'empty' ) )
+	
+	def tearDown(self):
+		shutil.rmtree( self.path )
+	
+	def left(self):
+		
+		found = []
+		for root, dirs, files in os.walk( self.path ):
+			for name in dirs + files:
+				found.append( os.path.relpath( os.path.join( root, name ), self.path ).replace( os.sep, '/' ) )
+		
+		return sorted( found )
+	
+	def test_recursive(self):
+		
+		removed = pr_utils.prune( self.path, '*.tmp', True, [ 'keep*' ] )
+		
+		# folders emptied by the prune go too, .svn is never looked at
+		self.assertEqual( len( removed ), 5 )
+		self.assertEqual( self.left(), [ '.svn', '.svn/f.tmp', 'b.con', 'empty', 'keep.tmp', 'other', 'other/e.con' ] )
+	
+	def test_flat(self):
+		
+		pr_utils.prune( self.path, [ '*.tmp', '*.con' ], False )
+		
+		self.assertEqual( self.left(), [ '.svn', '.svn/f.tmp', 'empty', 'other', 'other/e.con', 'sub', 'sub/c.tmp', 'sub/deep', 'sub/deep/d.tmp' ] )
+	
+	def test_empty(self):
+		
+		pr_utils.prune( self.path, 'nothing', True, [], True )
+		
+		self.assertTrue( 'empty' not in self.left() )
+		self.assertTrue( 'sub/deep/d.tmp' in self.left() )
+	
+	def test_missing(self):
+		self.assertEqual( pr_utils.prune( os.path.join( self.path, 'missing' ), '*' ), [] )
+
+if __name__ == "__main__":
+	unittest.main()
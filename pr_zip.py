@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import os.path
+import zipfile
+import hashlib
+import struct
+
+version = 1
+
+stored = [ '.dds', '.ogg', '.zip', '.png', '.jpg', '.bik', '.mp3' ]
+
+exclude = [ '.svn', 'assets' ]
+
+def write( source, destination, folder=None ):
+	
+	# zip64 only when needed, like 7za, server installers go past 2 GB. Written
+	# next to the destination and renamed, a failed run leaves no half zip.
+	temp = '%s.%s.tmp' % ( destination, os.getpid() )
+	
+	archive = zipfile.ZipFile( temp, 'w', zipfile.ZIP_DEFLATED, True )
+	
+	count = 0
+	try:
+		
+		try:
+			
+			if folder:
+				archive.write( source, folder )
+			
+			for path, name in entries( source, folder ):
+				archive.write( path, name, compression( path ) )
+				count += 1
+		
+		finally:
+			archive.close()
+	
+	except:
+		os.remove( temp )
+		raise
+	
+	if os.path.exists( destination ):
+		os.remove( destination )
+	os.rename( temp, destination )
+	
+	return count
+
+def digest( source, folder=None, content=False ):
+	
+	h = hashlib.sha1()
+	h.update( '%s %s %s\n' % ( version, folder, ' '.join( stored ) ) )
+	
+	if not content:
+		h.update( '%s\n' % os.path.abspath( source ) )
+	
+	for path, name in entries( source, folder ):
+		
+		if os.path.isdir( path ):
+			h.update( 'D %s\n' % name )
+			continue
+		
+		s = os.stat( path )
+		
+		if not content:
+			h.update( 'F %s %s %s\n' % ( name, s.st_size, int( s.st_mtime ) ) )
+			continue
+		
+		h.update( 'F %s %s\n' % ( name, s.st_size ) )
+		
+		f = open( path, 'rb' )
+		try:
+			while True:
+				data = f.read( 1024 * 1024 )
+				if not data:
+					break
+				h.update( data )
+		finally:
+			f.close()
+	
+	return h.hexdigest()
+
+def entries( source, folder=None ):
+	
+	for root, dirs, files in os.walk( source ):
+		
+		for d in dirs[:]:
+			if d.startswith( '.' ) or d.lower() in exclude:
+				dirs.remove( d )
+		dirs.sort()
+		
+		prefix = root[len( source ):].strip( os.sep )
+		if folder:
+			prefix = os.path.join( folder, prefix )
+		
+		for d in dirs:
+			yield os.path.join( root, d ), arcname( prefix, d )
+		
+		files.sort()
+		for f in files:
+			if f.startswith( '.' ):
+				continue
+			yield os.path.join( root, f ), arcname( prefix, f )
+
+def listing( path ):
+	
+	# ( name, crc, size ) of every entry, read from the central directory only
+	archive = zipfile.ZipFile( path )
+	try:
+		return [ ( i.filename, i.CRC, i.file_size ) for i in archive.infolist() ]
+	finally:
+		archive.close()
+
+def remove( path, names ):
+	
+	# removes entries, and folders with everything in them, by copying the
+	# compressed bytes of the other entries as they are and writing a new
+	# central directory, nothing is decompressed or recompressed. Zip64
+	# archives are read and written again instead. Names are matched like
+	# 7za d does, ignoring case and with either slash. Returns the number
+	# of entries removed, the archive is untouched when none match.
+	files, folders = selection( names )
+	
+	temp = '%s.%s.tmp' % ( path, os.getpid() )
+	
+	source = open( path, 'rb' )
+	try:
+		try:
+			
+			archive = zipfile.ZipFile( source )
+			infos = archive.infolist()
+			
+			keep = [ i for i in infos if not matched( i.filename, files, folders ) ]
+			
+			if len( keep ) == len( infos ):
+				return 0
+			
+			try:
+				copy_entries( source, archive, infos, keep, temp )
+			except zipfile.LargeZipFile:
+				rewrite_entries( archive, keep, temp )
+			
+			# the rewritten directory must describe exactly the kept entries
+			if listing( temp ) != [ ( i.filename, i.CRC, i.file_size ) for i in keep ]:
+				raise zipfile.BadZipfile( 'Rewritten %s does not match its kept entries' % path )
+		
+		except:
+			if os.path.exists( temp ):
+				os.remove( temp )
+			raise
+	
+	finally:
+		source.close()
+	
+	# a new file renamed into place, hard links to the old one keep it
+	os.remove( path )
+	os.rename( temp, path )
+	
+	return len( infos ) - len( keep )
+
+def copy_entries( source, archive, infos, keep, temp ):
+	
+	# the central directory records, in the order zipfile read them
+	records = {}
+	source.seek( archive.start_dir )
+	
+	for i in infos:
+		record = source.read( 46 )
+		if record[0:4] != zipfile.stringCentralDir:
+			raise zipfile.BadZipfile( 'Bad central directory record for %s' % i.filename )
+		# zip64 sizes and offsets, and their data descriptors, are not copied
+		if 0xFFFFFFFFL in struct.unpack( '<2L', record[20:28] ) + struct.unpack( '<L', record[42:46] ):
+			raise zipfile.LargeZipFile( '%s uses zip64' % i.filename )
+		n, m, k = struct.unpack( '<3H', record[28:34] )
+		records[id( i )] = record + source.read( n + m + k )
+	
+	target = open( temp, 'wb' )
+	try:
+		
+		central = []
+		for i in keep:
+			offset = target.tell()
+			if offset > 0xFFFFFFFFL:
+				raise zipfile.LargeZipFile( 'Archive needs zip64' )
+			copy_entry( source, target, i )
+			central.append( records[id( i )][0:42] + struct.pack( '<L', offset ) + records[id( i )][46:] )
+		
+		start = target.tell()
+		for record in central:
+			target.write( record )
+		end = target.tell()
+		
+		if len( central ) > 0xFFFF or end > 0xFFFFFFFFL:
+			raise zipfile.LargeZipFile( 'Archive needs zip64' )
+		
+		target.write( struct.pack( zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0, len( central ), len( central ), end - start, start, len( archive.comment ) ) )
+		target.write( archive.comment )
+	
+	finally:
+		target.close()
+
+def rewrite_entries( archive, keep, temp ):
+	
+	# the slow way, like 7za: every kept entry decompressed and compressed
+	# again, with zip64 wherever it is needed
+	target = zipfile.ZipFile( temp, 'w', zipfile.ZIP_DEFLATED, True )
+	try:
+		
+		for i in keep:
+			
+			info = zipfile.ZipInfo( i.filename, i.date_time )
+			info.compress_type = i.compress_type
+			info.external_attr = i.external_attr
+			info.comment = i.comment
+			
+			target.writestr( info, archive.read( i ) )
+		
+		target.comment = archive.comment
+	
+	finally:
+		target.close()
+
+def copy_entry( source, target, info ):
+	
+	source.seek( info.header_offset )
+	
+	header = source.read( 30 )
+	if header[0:4] != zipfile.stringFileHeader:
+		raise zipfile.BadZipfile( 'Bad local header for %s' % info.filename )
+	
+	flags, = struct.unpack( '<H', header[6:8] )
+	crc, = struct.unpack( '<L', header[14:18] )
+	n, m = struct.unpack( '<2H', header[26:30] )
+	
+	extra = source.read( n + m )[n:]
+	
+	# a zip64 entry has a longer data descriptor
+	while len( extra ) >= 4:
+		kind, length = struct.unpack( '<2H', extra[0:4] )
+		if kind == 1:
+			raise zipfile.LargeZipFile( '%s uses zip64' % info.filename )
+		extra = extra[4+length:]
+	
+	source.seek( info.header_offset + 30 )
+	target.write( header )
+	
+	remaining = n + m + info.compress_size
+	while remaining > 0:
+		data = source.read( min( remaining, 1024 * 1024 ) )
+		if not data:
+			raise zipfile.BadZipfile( 'Truncated data for %s' % info.filename )
+		target.write( data )
+		remaining -= len( data )
+	
+	# sizes and crc after the data, with or without its signature
+	if flags & 0x08:
+		descriptor = source.read( 12 )
+		if descriptor[0:4] == 'PK\x07\x08':
+			descriptor += source.read( 4 )
+			crc, = struct.unpack( '<L', descriptor[4:8] )
+		else:
+			crc, = struct.unpack( '<L', descriptor[0:4] )
+		target.write( descriptor )
+	
+	if crc != info.CRC:
+		raise zipfile.BadZipfile( 'CRC of %s differs between its local header and the central directory' % info.filename )
+
+def selection( names ):
+	
+	# ( files, folders ) for matched(), a name without a trailing slash
+	# also matches a folder of that name, like 7za
+	files = set()
+	folders = set()
+	
+	for name in names:
+		name = name.strip().replace( '\\', '/' ).lower()
+		if not name:
+			continue
+		if name.endswith( '/' ):
+			folders.add( name )
+		else:
+			files.add( name )
+			folders.add( name + '/' )
+	
+	return files, folders
+
+def matched( name, files, folders ):
+	
+	name = name.lower()
+	
+	if name in files or name in folders:
+		return True
+	
+	i = name.find( '/' )
+	while i != -1:
+		if name[0:i+1] in folders:
+			return True
+		i = name.find( '/', i+1 )
+	
+	return False
+
+def arcname( prefix, name ):
+	
+	if prefix:
+		name = os.path.join( prefix, name )
+	
+	return name.replace( os.sep, '/' )
+
+def compression( path ):
+	
+	if os.path.isdir( path ) or os.path.splitext( path )[1].lower() in stored:
+		return zipfile.ZIP_STORED
+	
+	return zipfile.ZIP_DEFLATED
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import os.path
+import shutil
+import struct
+import tempfile
+import unittest
+import zipfile
+import zlib
+
+import pr_zip
+
+class RemoveTest(unittest.TestCase):
+	
+	def setUp(self):
+		
+		self.path = tempfile.mkdtemp()
+		self.zip = os.path.join( self.path, 'test.zip' )
+		
+		self.data = {
+			'menu/': '',
+			'menu/super.con': 'super ' * 200,
+			'menu/blob.con': 'blob ' * 300,
+			'vehicles/tank.tweak': 'tank ' * 100,
+			'vehicles/jeep.tweak': 'jeep ' * 100,
+			'textures/grass.dds': os.urandom( 2000 ),
+			'readme.txt': 'readme',
+		}
+		
+		archive = zipfile.ZipFile( self.zip, 'w', zipfile.ZIP_DEFLATED )
+		for name in sorted( self.data.keys() ):
+			if name.endswith( '.dds' ):
+				archive.writestr( zipfile.ZipInfo( name ), self.data[name] )
+			else:
+				archive.writestr( name, self.data[name] )
+		archive.comment = 'comment'
+		archive.close()
+	
+	def tearDown(self):
+		shutil.rmtree( self.path )
+	
+	def check(self, expected):
+		
+		archive = zipfile.ZipFile( self.zip )
+		try:
+			
+			self.assertEqual( archive.testzip(), None )
+			self.assertEqual( archive.comment, 'comment' )
+			self.assertEqual( sorted( archive.namelist() ), sorted( expected ) )
+			
+			for name in expected:
+				self.assertEqual( archive.read( name ), self.data[name] )
+			
+			for name, crc, size in pr_zip.listing( self.zip ):
+				self.assertEqual( crc, zlib.crc32( self.data[name] ) & 0xFFFFFFFF )
+				self.assertEqual( size, len( self.data[name] ) )
+		
+		finally:
+			archive.close()
+	
+	def test_files(self):
+		
+		self.assertEqual( pr_zip.remove( self.zip, [ 'menu\\blob.con\r', 'READMe.txt' ] ), 2 )
+		self.check( [ 'menu/', 'menu/super.con', 'vehicles/tank.tweak', 'vehicles/jeep.tweak', 'textures/grass.dds' ] )
+	
+	def test_stored(self):
+		
+		self.assertEqual( pr_zip.remove( self.zip, [ 'menu/super.con' ] ), 1 )
+		self.assertEqual( zipfile.ZipFile( self.zip ).getinfo( 'textures/grass.dds' ).compress_type, zipfile.ZIP_STORED )
+		self.check( [ 'menu/', 'menu/blob.con', 'vehicles/tank.tweak', 'vehicles/jeep.tweak', 'textures/grass.dds', 'readme.txt' ] )
+	
+	def test_folders(self):
+		
+		self.assertEqual( pr_zip.remove( self.zip, [ 'menu/', 'vehicles' ] ), 5 )
+		self.check( [ 'textures/grass.dds', 'readme.txt' ] )
+	
+	def test_nothing(self):
+		
+		before = open( self.zip, 'rb' ).read()
+		
+		self.assertEqual( pr_zip.remove( self.zip, [ 'missing.con', '' ] ), 0 )
+		self.assertEqual( open( self.zip, 'rb' ).read(), before )
+	
+	def test_links(self):
+		
+		if not hasattr( os, 'link' ):
+			return
+		
+		other = os.path.join( self.path, 'linked.zip' )
+		os.link( self.zip, other )
+		before = open( other, 'rb' ).read()
+		
+		pr_zip.remove( self.zip, [ 'readme.txt' ] )
+		
+		self.assertEqual( open( other, 'rb' ).read(), before )
+	
+	def test_zip64(self):
+		
+		# an entry with a zip64 extra field is not copied raw, the archive
+		# is rewritten instead
+		archive = zipfile.ZipFile( self.zip, 'a' )
+		info = zipfile.ZipInfo( 'big.bin' )
+		info.extra = struct.pack( '<2H2Q', 1, 16, 100, 100 )
+		self.data['big.bin'] = 'x' * 100
+		archive.writestr( info, self.data['big.bin'] )
+		archive.close()
+		
+		self.assertEqual( pr_zip.remove( self.zip, [ 'readme.txt' ] ), 1 )
+		self.check( [ 'menu/', 'menu/super.con', 'menu/blob.con', 'vehicles/tank.tweak', 'vehicles/jeep.tweak', 'textures/grass.dds', 'big.bin' ] )
+		self.assertEqual( [ f for f in os.listdir( self.path ) if f.endswith( '.tmp' ) ], [] )
+
+if __name__ == "__main__":
+	unittest.main()